@@ -41,7 +41,7 @@ required_packages = "streamlit numpy scipy numba bokeh skimage:scikit_image mrcf
 import_with_auto_install(required_packages)
 
 
-import argparse, base64, gc, io, os, pathlib, random, socket, stat, tempfile, urllib, warnings
+import argparse, base64, gc, io, os, pathlib, random, socket, stat, tempfile, threading, urllib, warnings
 from getpass import getuser
 from itertools import product
 from math import fmod
@@ -58,8 +58,6 @@ from bokeh.models import Button, ColumnDataSource, CustomJS, Label, LinearColorM
 from bokeh.models.tools import CrosshairTool, HoverTool
 from bokeh.plotting import figure
 
-from finufft import nufft2d2
-
 import mrcfile
 
 from numba import jit, set_num_threads, prange
@@ -438,6 +436,7 @@ def main(args):
                 lp_fraction = st.number_input('Fourier low-pass (%)', value=0.0, min_value=0.0, max_value=100.0, step=10.0, format="%.2f", help="Perform low-pass Fourier filtering of the power spectra with filter=0.5 at this percentage of the Nyquist resolution") / 100.0
                 pnx = int(st.number_input('FFT X-dim size (pixels)', value=512, min_value=min(nx, 128), step=2, help="Set the size of FFT in X-dimension to this number of pixels", key="pnx"))
                 pny = int(st.number_input('FFT Y-dim size (pixels)', value=1024, min_value=min(ny, 512), step=2, help="Set the size of FFT in Y-dimension to this number of pixels", key="pny"))
+                fft_precision = st.radio(label="FFT precision", options="double single".split(), index=0, help="Compute the power spectra and phases in double (complex128) or single (complex64) precision. Single precision halves the memory and is faster", horizontal=True, key="fft_precision")
             with st.expander(label="Simulation", expanded=False):
                 ball_radius = st.number_input('Gaussian radius (Å)', value=0.0, min_value=0.0, max_value=helical_radius, step=5.0, format="%.1f", help="A 3-D Gaussian function will be used to reprsent each subunit in the simulated helix. The Gaussian function will fall off from 1 to 0.5 at this radius. A value <=0 will disable the simulation", key="ball_radius")
                 show_simu = True if ball_radius > 0 else False
@@ -480,9 +479,8 @@ def main(args):
             phase_diff = resize_rescale_power_spectra(data, nyquist_res=2*apix, cutoff_res=(cutoff_res_y, cutoff_res_x), 
                     output_size=(pny, pnx), log=0, low_pass_fraction=0, high_pass_fraction=0, norm=0)
         else:
-            pwr, phase = compute_power_spectra(data, apix=apix, cutoff_res=(cutoff_res_y, cutoff_res_x), 
-                    output_size=(pny, pnx), log=log_xform, low_pass_fraction=lp_fraction, high_pass_fraction=hp_fraction)
-            phase_diff = compute_phase_difference_across_meridian(phase)                
+            pwr, phase, phase_diff = compute_power_spectra(data, apix=apix, cutoff_res=(cutoff_res_y, cutoff_res_x), 
+                    output_size=(pny, pnx), log=log_xform, low_pass_fraction=lp_fraction, high_pass_fraction=hp_fraction, precision=fft_precision)
         
         if input_image2:
             if input_type2 in ["PS"]:
@@ -496,9 +494,8 @@ def main(args):
                 phase_diff2 = resize_rescale_power_spectra(data2, nyquist_res=2*apix2, cutoff_res=(cutoff_res_y, cutoff_res_x), 
                     output_size=(pny, pnx), log=0, low_pass_fraction=0, high_pass_fraction=0, norm=0)
             else:
-                pwr2, phase2 = compute_power_spectra(data2, apix=apix2, cutoff_res=(cutoff_res_y, cutoff_res_x), 
-                        output_size=(pny, pnx), log=log_xform, low_pass_fraction=lp_fraction, high_pass_fraction=hp_fraction)
-                phase_diff2 = compute_phase_difference_across_meridian(phase2)                
+                pwr2, phase2, phase_diff2 = compute_power_spectra(data2, apix=apix2, cutoff_res=(cutoff_res_y, cutoff_res_x), 
+                        output_size=(pny, pnx), log=log_xform, low_pass_fraction=lp_fraction, high_pass_fraction=hp_fraction, precision=fft_precision)
         else:
             pwr2 = None
             phase2 = None
@@ -605,9 +602,8 @@ def main(args):
                     proj = proj * tapering_image
                 else:
                     apix_simu = apix
-                proj_pwr, proj_phase = compute_power_spectra(proj, apix=apix_simu, cutoff_res=(cutoff_res_y, cutoff_res_x), 
-                        output_size=(pny, pnx), log=log_xform, low_pass_fraction=lp_fraction, high_pass_fraction=hp_fraction)
-                proj_phase_diff = compute_phase_difference_across_meridian(proj_phase)                
+                proj_pwr, proj_phase, proj_phase_diff = compute_power_spectra(proj, apix=apix_simu, cutoff_res=(cutoff_res_y, cutoff_res_x), 
+                        output_size=(pny, pnx), log=log_xform, low_pass_fraction=lp_fraction, high_pass_fraction=hp_fraction, precision=fft_precision)
                 items += [(show_pwr_simu, proj_pwr, "Simulated Power Spectra", show_phase_simu, proj_phase, show_phase_diff_simu, proj_phase_diff, "Simulated Phase Diff Across Meridian", show_yprofile_simu)]
 
             figs = []
@@ -881,7 +877,7 @@ def main(args):
                             ny, nx = data.shape
                             apix_simu = apix
                         params = (movie_mode, twist, rise, csym, noise, helical_radius, ball_radius, az, ny, nx, apix_simu)
-                    movie_filename = create_movie(movie_frames, tilt, params, pny, pnx, mask_radius, cutoff_res_x, cutoff_res_y, show_pseudo_color, const_image_color, log_xform, lp_fraction, hp_fraction, fft_top_only)
+                    movie_filename = create_movie(movie_frames, tilt, params, pny, pnx, mask_radius, cutoff_res_x, cutoff_res_y, show_pseudo_color, const_image_color, log_xform, lp_fraction, hp_fraction, fft_top_only, fft_precision)
                     st.video(movie_filename) # it always show the video using the entire column width
 
             #del data_all, data, figs_grid
@@ -900,7 +896,7 @@ def main(args):
 
 
 @st.cache_data(persist='disk', max_entries=1, show_spinner=False)
-def create_movie(movie_frames, tilt_max, movie_mode_params, pny, pnx, mask_radius, cutoff_res_x, cutoff_res_y, show_pseudo_color, const_image_color, log_xform, lp_fraction, hp_fraction, fft_top_only):
+def create_movie(movie_frames, tilt_max, movie_mode_params, pny, pnx, mask_radius, cutoff_res_x, cutoff_res_y, show_pseudo_color, const_image_color, log_xform, lp_fraction, hp_fraction, fft_top_only, fft_precision="double"):
     import_with_auto_install("moviepy selenium".split())
     if movie_mode_params[0] == 0:
         movie_mode, data_all, noise, apix = movie_mode_params
@@ -932,8 +928,8 @@ def create_movie(movie_frames, tilt_max, movie_mode_params, pny, pnx, mask_radiu
         fig_proj = create_layerline_image_figure(proj, cutoff_res_x, cutoff_res_y, helical_radius, tilt, phase=None, fft_top_only=fft_top_only, pseudo_color=show_pseudo_color, const_image_color=const_image_color, title=title, yaxis_visible=False, tooltips=None)
         figs.append(fig_proj)
 
-        proj_pwr, proj_phase = compute_power_spectra(proj, apix=apix, cutoff_res=(cutoff_res_y, cutoff_res_x), 
-            output_size=(pny, pnx), log=log_xform, low_pass_fraction=lp_fraction, high_pass_fraction=hp_fraction)
+        proj_pwr, proj_phase, phase_diff = compute_power_spectra(proj, apix=apix, cutoff_res=(cutoff_res_y, cutoff_res_x), 
+            output_size=(pny, pnx), log=log_xform, low_pass_fraction=lp_fraction, high_pass_fraction=hp_fraction, precision=fft_precision)
         title = f"Power Spectra"
         fig_pwr = create_layerline_image_figure(proj_pwr, cutoff_res_x, cutoff_res_y, helical_radius, tilt, phase=None, fft_top_only=fft_top_only, pseudo_color=show_pseudo_color, const_image_color=const_image_color, title=title, yaxis_visible=False, tooltips=None)
         #from bokeh.models import Label
@@ -941,7 +937,6 @@ def create_movie(movie_frames, tilt_max, movie_mode_params, pny, pnx, mask_radiu
         fig_pwr.add_layout(label)
         figs.append(fig_pwr)
 
-        phase_diff = compute_phase_difference_across_meridian(proj_phase)
         title = f"Phase Diff Across Meridian"
         fig_phase = create_layerline_image_figure(phase_diff, cutoff_res_x, cutoff_res_y, helical_radius, tilt, phase=None, fft_top_only=fft_top_only, pseudo_color=show_pseudo_color, const_image_color=const_image_color, title=title, yaxis_visible=False, tooltips=None)
         figs.append(fig_phase)
@@ -1153,7 +1148,7 @@ def obtain_input_image(column, param_i=0, image_index_sync=0):
             if input_mode == 0:  # "upload a mrc/mrcs file":
                 help = None
                 if max_map_size>0: help = warning_map_size
-                fileobj = st.file_uploader("Upload a mrc or mrcs file ", type=['mrc', 'mrcs', 'map', 'map.gz', 'tnf'], help=help, key=f'upload_{param_i}')
+                fileobj = st.file_uploader("Upload a mrc or mrcs file ", type=['mrc', 'mrcs', 'map', 'map.gz', 'tnf', 'npz'], help=help, key=f'upload_{param_i}')
                 if fileobj is not None:
                     is_pwr_auto = fileobj.name.find("ps.mrcs")!=-1
                     is_pd_auto = fileobj.name.find("pd.mrcs")!=-1
@@ -1169,9 +1164,19 @@ def obtain_input_image(column, param_i=0, image_index_sync=0):
                     help = "An online url (http:// or ftp://) or a local file path (/path/to/your/structure.mrc)"
                     if max_map_size>0: help += f". {warning_map_size}"
                     image_url = st.text_input(label=label, help=help, key=key_image_url).strip()
-                    is_pwr_auto = image_url.find("ps.mrcs")!=-1
-                    is_pd_auto = image_url.find("pd.mrcs")!=-1
-                    data_all, map_crs_auto, apix_auto = get_2d_image_from_url(image_url)
+                    # the folders of the group averages of hill_power_spectra.py --outputFormat npz: <prefix>.ps/<pid>.npz
+                    is_pwr_auto = image_url.find("ps.mrcs")!=-1 or image_url.rstrip("/").endswith(".ps") or image_url.find(".ps/")!=-1
+                    is_pd_auto = image_url.find("pd.mrcs")!=-1 or image_url.rstrip("/").endswith(".pd") or image_url.find(".pd/")!=-1
+                    if not is_hosted() and os.path.isdir(image_url):
+                        # only the selected group is read. the folder can still be receiving the groups being computed
+                        pids = get_output_store_pids(image_url)
+                        if not pids:
+                            st.warning(f"No groups have been saved in {image_url} yet")
+                            st.stop()
+                        pid = st.selectbox(label="Group (pid in the .lst file):", options=pids, key=f'pid_{param_i}') if len(pids)>1 else pids[0]
+                        data_all, map_crs_auto, apix_auto = get_2d_image_from_output_store(f"{image_url}/{pid}.npz")
+                    else:
+                        data_all, map_crs_auto, apix_auto = get_2d_image_from_url(image_url)
                     is_3d_auto = guess_if_3d(filename=image_url, data=data_all)
             nz, ny, nx = data_all.shape
             if nz > 1:
@@ -1595,12 +1600,30 @@ def compute_layer_line_positions(twist, rise, csym, radius, tilt, cutoff_res, m_
 
 @st.cache_data(persist='disk', max_entries=1, show_spinner=False)
 def compute_phase_difference_across_meridian(phase):
+    # phase: the phases (radians) or the complex Fourier transform
     # https://numpy.org/doc/stable/reference/generated/numpy.fft.fftfreq.html
+    if np.iscomplexobj(phase):
+        cos = phase_difference_cosine_across_meridian(np.ascontiguousarray(phase))
+        phase_diff = np.rad2deg(np.arccos(np.clip(cos, -1, 1)))   # set the range to [0, 180]. 0 -> even order, 180 - odd order
+        return phase_diff
     phase_diff = phase * 0
     phase_diff[..., 1:] = phase[..., 1:] - phase[..., 1:][..., ::-1]
     phase_diff = np.rad2deg(np.arccos(np.cos(phase_diff)))   # set the range to [0, 180]. 0 -> even order, 180 - odd order
     return phase_diff
 
+@jit(nopython=True, cache=True, nogil=True, parallel=True)
+def phase_difference_cosine_across_meridian(fft):
+    # cos(phase differences) = Re(F * conj(F_mirror)) / (|F| * |F_mirror|) in a single pass without computing the phases
+    ny, nx = fft.shape
+    cos = np.ones((ny, nx), dtype=fft.real.dtype)
+    for iy in prange(ny):
+        for ix in range(1, nx):
+            a = fft[iy, ix]
+            b = fft[iy, nx-ix]
+            d = np.sqrt((a.real*a.real + a.imag*a.imag) * (b.real*b.real + b.imag*b.imag))
+            if d>0: cos[iy, ix] = (a.real*b.real + a.imag*b.imag) / d
+    return cos
+
 @st.cache_data(persist='disk', max_entries=1, show_spinner=False)
 def resize_rescale_power_spectra(data, nyquist_res, cutoff_res=None, output_size=None, log=True, low_pass_fraction=0, high_pass_fraction=0, norm=1):
     #from scipy.ndimage import map_coordinates
@@ -1618,8 +1641,8 @@ def resize_rescale_power_spectra(data, nyquist_res, cutoff_res=None, output_size
     return pwr
 
 @st.cache_data(persist='disk', max_entries=1, show_spinner=False)
-def compute_power_spectra(data, apix, cutoff_res=None, output_size=None, log=True, low_pass_fraction=0, high_pass_fraction=0):
-    fft = fft_rescale(data, apix=apix, cutoff_res=cutoff_res, output_size=output_size)
+def compute_power_spectra(data, apix, cutoff_res=None, output_size=None, log=True, low_pass_fraction=0, high_pass_fraction=0, precision="double"):
+    fft = fft_rescale(data, apix=apix, cutoff_res=cutoff_res, output_size=output_size, precision=precision)
     fft = np.fft.fftshift(fft)  # shift fourier origin from corner to center
 
     if log: pwr = np.log1p(np.abs(fft))
@@ -1629,10 +1652,16 @@ def compute_power_spectra(data, apix, cutoff_res=None, output_size=None, log=Tru
     pwr = normalize(pwr, percentile=(0, 100))
 
     phase = np.angle(fft, deg=False)
-    return pwr, phase
+    phase_diff = compute_phase_difference_across_meridian(fft)
+    return pwr, phase, phase_diff
 
 @st.cache_data(persist='disk', max_entries=1, show_spinner=False)
-def fft_rescale(image, apix=1.0, cutoff_res=None, output_size=None):
+def fft_rescale(image, apix=1.0, cutoff_res=None, output_size=None, backend="auto", precision="double"):
+    # backend: nufft - non-uniform FFT (finufft), accurate to the requested eps=1e-6
+    #          czt   - chirp-z/zoom FFT along each axis, exact to double precision round-off
+    #          fft   - zero-pad (or fold) to the FFT size whose grid contains the target frequencies, exact
+    #          auto  - fft if the target grid is a sub-grid of an affordable FFT, otherwise czt
+    # precision: double (complex128) or single (complex64)
     if cutoff_res:
         cutoff_res_y, cutoff_res_x = cutoff_res
     else:
@@ -1641,24 +1670,122 @@ def fft_rescale(image, apix=1.0, cutoff_res=None, output_size=None):
         ony, onx = output_size
     else:
         ony, onx = image.shape
-    freq_y = np.fft.fftfreq(ony) * 2*apix/cutoff_res_y
-    freq_x = np.fft.fftfreq(onx) * 2*apix/cutoff_res_x
-    Y, X = np.meshgrid(freq_y, freq_x, indexing='ij')
-    Y = (2*np.pi * Y).flatten(order='C')
-    X = (2*np.pi * X).flatten(order='C')
-
-    #from finufft import nufft2d2
-    fft = nufft2d2(x=Y, y=X, f=image.astype(np.complex128), eps=1e-6)
-    fft = fft.reshape((ony, onx))
-
-    # phase shifts for real-space shifts by half of the image box in both directions
-    phase_shift = np.ones(fft.shape)
-    phase_shift[1::2, :] *= -1
-    phase_shift[:, 1::2] *= -1
-    fft *= phase_shift
+
+    plan = get_fft_rescale_plan(image.shape, (ony, onx), float(apix), (float(cutoff_res_y), float(cutoff_res_x)), backend, precision)
+    with plan["lock"]:
+        if plan["backend"] == "nufft":
+            fft = plan["nufft"].execute(image.astype(plan["dtype"]))
+            fft = fft.reshape((ony, onx))
+            # phase shifts for real-space shifts by half of the image box in both directions
+            fft *= plan["phase_shift"]
+        else:
+            # the half box phase shifts are included in the plans
+            fft = zoom_dft(image.astype(plan["dtype"]), plan["x"], axis=-1)
+            fft = zoom_dft(fft, plan["y"], axis=-2)
     # now fft has the same layout and phase origin (i.e. np.fft.ifft2(fft) would obtain original image)
     return fft
 
+@st.cache_resource(max_entries=8, show_spinner=False)
+def get_fft_rescale_plan(image_shape, output_size, apix, cutoff_res, backend="auto", precision="double"):
+    # the setup shared by all fft_rescale calls of the same geometry across reruns:
+    # the finufft plan and its non-uniform points, or the chirp-z/fft plans of both axes
+    ny, nx = image_shape
+    ony, onx = output_size
+    cutoff_res_y, cutoff_res_x = cutoff_res
+    if backend == "auto":
+        backend = choose_fft_rescale_backend(image_shape, output_size, apix, cutoff_res)
+    assert backend in ["nufft", "czt", "fft"], f"unknown fft_rescale backend: {backend}"
+
+    assert precision in ["single", "double"], f"unknown precision: {precision}"
+    dtype = np.complex64 if precision == "single" else np.complex128
+    real_dtype = np.float32 if precision == "single" else np.float64
+
+    plan = {"backend": backend, "dtype": dtype, "lock": threading.Lock()}
+    if backend == "nufft":
+        freq_y = np.fft.fftfreq(ony) * 2*apix/cutoff_res_y
+        freq_x = np.fft.fftfreq(onx) * 2*apix/cutoff_res_x
+        Y, X = np.meshgrid(freq_y, freq_x, indexing='ij')
+        Y = (2*np.pi * Y).flatten(order='C')
+        X = (2*np.pi * X).flatten(order='C')
+
+        plan["nufft"] = finufft.Plan(2, (ny, nx), n_trans=1, eps=1e-6, dtype=np.dtype(dtype).name)
+        plan["nufft"].setpts(x=Y.astype(real_dtype), y=X.astype(real_dtype))
+
+        phase_shift = np.ones((ony, onx), dtype=real_dtype)
+        phase_shift[1::2, :] *= -1
+        phase_shift[:, 1::2] *= -1
+        plan["phase_shift"] = phase_shift
+    else:
+        plan["x"] = plan_zoom_dft(nx, onx, 2*apix/cutoff_res_x, backend=backend, dtype=dtype)
+        plan["y"] = plan_zoom_dft(ny, ony, 2*apix/cutoff_res_y, backend=backend, dtype=dtype)
+    return plan
+
+def choose_fft_rescale_backend(image_size, output_size, apix, cutoff_res):
+    # the fft backend is exact if each output grid is a sub-grid of a regular FFT grid of size m=on/scale
+    # and is chosen if that FFT is not much larger than the chirp-z transform of the same axis
+    for n, on, res in zip(image_size, output_size, cutoff_res):
+        m = on * res / (2*apix)
+        if abs(m - round(m)) > 1e-6 * m: return "czt"
+        if round(m) > 2 * scipy.fft.next_fast_len(n + on - 1): return "czt"
+    return "fft"
+
+def plan_zoom_dft(n, m, scale, backend="czt", dtype=np.complex128):
+    # DFT of n samples at the m frequencies np.fft.fftfreq(m)*scale (cycles/pixel)
+    # with the same phase origin as finufft (i.e. sample n//2 is at the origin)
+    # and the sign flip of every other output for the real-space shift by half of the box
+    k = np.round(np.fft.fftfreq(m) * m).astype(int)  # signed frequency indices in fft order
+    step = scale / m
+    plan = {"backend": backend, "n": n, "m": m}
+    factor = np.exp(2j*np.pi*step*k*(n//2))
+    factor[1::2] *= -1
+    if backend == "fft":
+        plan["mfft"] = int(round(1/step))
+        assert abs(plan["mfft"]*step - 1) < 1e-6, f"the fft backend requires an output grid on a regular FFT grid: step={step} cycles/pixel"
+        plan["index"] = k % plan["mfft"]
+    else:
+        # chirp-z transform (Bluestein): X[k] = w^(k^2/2) * sum_j (x[j] * a^-j * w^(j^2/2)) * w^(-(k-j)^2/2)
+        # with w = exp(-2i*pi*step) and a = exp(2i*pi*step*k.min()), computed as a circular convolution
+        nfft = scipy.fft.next_fast_len(n + m - 1)
+        chirp = lambda t: np.exp(-1j*np.pi*step*(t.astype(np.float64)**2))   # w^(t^2/2)
+        j = np.arange(n)
+        plan["pre"] = (np.exp(-2j*np.pi*step*k.min()*j) * chirp(j)).astype(dtype)
+        h = np.zeros(nfft, dtype=np.complex128)
+        h[:m] = 1/chirp(np.arange(m))
+        h[nfft-n+1:] = 1/chirp(np.arange(-n+1, 0))
+        plan["nfft"] = nfft
+        plan["kernel"] = scipy.fft.fft(h).astype(dtype)
+        factor *= np.fft.ifftshift(chirp(np.arange(m)))
+    plan["factor"] = factor.astype(dtype)
+    return plan
+
+def zoom_dft(data, plan, axis=-1):
+    n, m = plan["n"], plan["m"]
+    assert data.shape[axis] == n
+    shape = [1] * data.ndim
+    if plan["backend"] == "fft":
+        mfft = plan["mfft"]
+        if n > mfft:    # fold (alias) the input to the FFT size
+            npad = -n % mfft
+            pad = [(0, 0)] * data.ndim
+            pad[axis] = (0, npad)
+            data = np.pad(data, pad)
+            data = np.moveaxis(data, axis, -1)
+            data = data.reshape(data.shape[:-1] + ((n+npad)//mfft, mfft)).sum(axis=-2)
+            data = np.moveaxis(data, -1, axis)
+        ret = scipy.fft.fft(data, n=mfft, axis=axis)
+        ret = np.take(ret, plan["index"], axis=axis)
+    else:
+        shape[axis] = n
+        ret = scipy.fft.fft(data * plan["pre"].reshape(shape), n=plan["nfft"], axis=axis)
+        shape[axis] = plan["nfft"]
+        ret *= plan["kernel"].reshape(shape)
+        ret = scipy.fft.ifft(ret, axis=axis, overwrite_x=True)
+        ret = np.take(ret, np.arange(m), axis=axis)
+        ret = np.fft.ifftshift(ret, axes=axis)
+    shape[axis] = m
+    ret *= plan["factor"].reshape(shape)
+    return ret
+
 @st.cache_data(persist='disk', max_entries=1, show_spinner=False)
 def auto_correlation(data, sqrt=True, high_pass_fraction=0):
     #from scipy.signal import correlate2d
@@ -1814,6 +1941,8 @@ def auto_vertical_center(data, n_theta=180):
 def rotate_shift_image(data, angle=0, pre_shift=(0, 0), post_shift=(0, 0), rotation_center=None, order=1):
     # pre_shift/rotation_center/post_shift: [y, x]
     if angle==0 and pre_shift==[0,0] and post_shift==[0,0]: return data*1.0
+    if order == 1:
+        return rotate_shift_images(data[np.newaxis], angles=angle, pre_shift=pre_shift, post_shift=post_shift, rotation_center=rotation_center, order=order)[0]
     ny, nx = data.shape
     if rotation_center is None:
         rotation_center = np.array((ny//2, nx//2), dtype=np.float32)
@@ -1830,6 +1959,88 @@ def rotate_shift_image(data, angle=0, pre_shift=(0, 0), post_shift=(0, 0), rotat
     ret = affine_transform(data, matrix=m, offset=offset, order=order, mode='constant')
     return ret
 
+def rotate_shift_images(images, angles, pre_shift=None, post_shift=None, rotation_center=None, taper=None, order=1, out=None):
+    # rotate/shift each image of a stack (n, ny, nx) by its own angle (degrees) and shifts ([y, x] pixels, one pair or one per image)
+    # with the same conventions as rotate_shift_image, multiply the rotated images with the tapering filter if provided,
+    # and write the results into out (can be images itself for in-place operation)
+    # order: 1 - bilinear (same as scipy affine_transform), 3 - cubic convolution (Keys, a=-0.5)
+    assert order in [1, 3], f"order={order} is not supported. use 1 (bilinear) or 3 (cubic convolution)"
+    n, ny, nx = images.shape
+    angles = np.broadcast_to(np.asarray(angles, dtype=np.float64), (n,))
+    pre_shift = np.broadcast_to(np.asarray((0, 0) if pre_shift is None else pre_shift, dtype=np.float64), (n, 2))
+    post_shift = np.broadcast_to(np.asarray((0, 0) if post_shift is None else post_shift, dtype=np.float64), (n, 2))
+    if rotation_center is None:
+        rotation_center = (ny//2, nx//2)
+    rotation_center = np.asarray(rotation_center, dtype=np.float64)
+    ang = np.deg2rad(angles)
+    m = np.empty((n, 2, 2))
+    m[:, 0, 0], m[:, 0, 1] = np.cos(ang), np.sin(ang)
+    m[:, 1, 0], m[:, 1, 1] = -np.sin(ang), np.cos(ang)
+    offsets = -np.einsum('nij,nj->ni', m, post_shift)   # post_rotation shift
+    offsets += rotation_center - np.einsum('nij,j->ni', m, rotation_center)    # rotation around the specified center
+    offsets -= pre_shift    # pre-rotation shift
+    if taper is None:
+        taper = np.ones((ny, nx), dtype=np.float32)
+    if out is None:
+        out = np.empty_like(images)
+    inplace = np.shares_memory(images, out)
+    _rotate_shift_images(images, m, offsets, taper, order, inplace, out)
+    return out
+
+@jit(nopython=True, cache=True, nogil=True, parallel=True)
+def _rotate_shift_images(images, matrices, offsets, taper, order, inplace, out):
+    n, ny, nx = images.shape
+    for i in range(n):
+        src = images[i].copy() if inplace else images[i]
+        m00, m01, m10, m11 = matrices[i, 0, 0], matrices[i, 0, 1], matrices[i, 1, 0], matrices[i, 1, 1]
+        dy, dx = offsets[i, 0], offsets[i, 1]
+        identity = m00==1 and m01==0 and m10==0 and m11==1 and dy==0 and dx==0
+        for oy in prange(ny):
+            for ox in range(nx):
+                if identity:
+                    v = src[oy, ox]
+                else:
+                    y = m00*oy + m01*ox + dy
+                    x = m10*oy + m11*ox + dx
+                    if order == 1:
+                        v = _interpolate_linear(src, y, x)
+                    else:
+                        v = _interpolate_cubic(src, y, x)
+                out[i, oy, ox] = v * taper[oy, ox]
+
+@jit(nopython=True, cache=True, nogil=True)
+def _interpolate_linear(data, y, x):
+    # zero outside of the image, as scipy.ndimage mode='constant'
+    ny, nx = data.shape
+    if y < 0 or y > ny-1 or x < 0 or x > nx-1: return 0.0
+    y0, x0 = int(y), int(x)
+    y1, x1 = min(y0+1, ny-1), min(x0+1, nx-1)
+    fy, fx = y-y0, x-x0
+    return (1-fy)*((1-fx)*data[y0, x0] + fx*data[y0, x1]) + fy*((1-fx)*data[y1, x0] + fx*data[y1, x1])
+
+@jit(nopython=True, cache=True, nogil=True)
+def _cubic_convolution_weight(t):
+    a = -0.5
+    t = abs(t)
+    if t <= 1: return ((a+2)*t - (a+3))*t*t + 1
+    if t < 2: return ((a*t - 5*a)*t + 8*a)*t - 4*a
+    return 0.0
+
+@jit(nopython=True, cache=True, nogil=True)
+def _interpolate_cubic(data, y, x):
+    # zero outside of the image, edge pixels are replicated for the 4x4 neighborhood
+    ny, nx = data.shape
+    if y < 0 or y > ny-1 or x < 0 or x > nx-1: return 0.0
+    y0, x0 = int(y), int(x)
+    v = 0.0
+    for j in range(-1, 3):
+        wy = _cubic_convolution_weight(y-(y0+j))
+        yi = min(max(y0+j, 0), ny-1)
+        for k in range(-1, 3):
+            xi = min(max(x0+k, 0), nx-1)
+            v += wy * _cubic_convolution_weight(x-(x0+k)) * data[yi, xi]
+    return v
+
 @st.cache_data(persist='disk', max_entries=1, show_spinner=False)
 def generate_projection(data, az=0, tilt=0, noise=0, output_size=None):
     #from scipy.spatial.transform import Rotation as R
@@ -1979,7 +2190,7 @@ def guess_if_is_positive_contrast(data):
 
 @st.cache_data(persist='disk', max_entries=1, show_spinner=False)
 def guess_if_3d(filename, data=None):
-    if filename.endswith(".mrcs"): return False
+    if filename.endswith((".mrcs", ".npz")): return False
     if filename.startswith("cryosparc") and filename.endswith("_class_averages.mrc"): return False    # cryosparc_P*_J*_*_class_averages.mrc
     if data is None: return None
     if len(data.shape)<3: return False
@@ -2062,6 +2273,8 @@ def get_emdb_map(emd_id: str):
 
 @st.cache_data(persist='disk', max_entries=1, show_spinner=False)
 def get_2d_image_from_url(url):
+    if not is_hosted() and os.path.exists(url):    # a local file
+        return get_2d_image_from_file(url)
     url_final = get_direct_url(url)    # convert cloud drive indirect url to direct url
     fileobj = download_file_from_url(url_final)
     if fileobj is None:
@@ -2070,8 +2283,20 @@ def get_2d_image_from_url(url):
     data = get_2d_image_from_file(fileobj.name)
     return data
 
+def get_output_store_pids(folder):
+    # the groups saved so far in a folder of hill_power_spectra.py --outputFormat npz
+    return sorted(int(f.stem) for f in pathlib.Path(folder).glob("*.npz") if f.stem.isdigit())
+
+def get_2d_image_from_output_store(filename):
+    # the average of one group (<pid>.npz) of hill_power_spectra.py --outputFormat npz, saved divided by its "scale"
+    with np.load(filename) as store:
+        data = store["data"].astype(np.float32) * float(store["scale"])
+        apix = float(store["apix"])
+    return data[np.newaxis], [1, 2, 3], apix
+
 #@st.cache_data(persist='disk', max_entries=1, show_spinner=False)
 def get_2d_image_from_file(filename):
+    if filename.endswith(".npz"): return get_2d_image_from_output_store(filename)
     try:
         #import mrcfile
         with mrcfile.open(filename) as mrc:
@@ -25,6 +25,7 @@ SOFTWARE.
 """
 
 import sys, pathlib, math
+from functools import lru_cache
 
 def import_with_auto_install(packages, scope=locals()):
     if isinstance(packages, str): packages=[packages]
@@ -39,14 +40,40 @@ def import_with_auto_install(packages, scope=locals()):
             import subprocess
             subprocess.call(f'pip install {package_pip_name}', shell=True)
             scope[package_import_name] =  __import__(package_import_name)
-import_with_auto_install("numpy scipy pandas mrcfile finufft joblib".split())
+import_with_auto_install("numpy scipy pandas mrcfile finufft joblib numba".split())
 
 import numpy as np
 
 def main():
     args =  parse_command_line()
 
-    data = image2dataframe(args.inputImage)
+    import os, time
+    import pandas as pd
+
+    if args.outputFormat!="npz" and (args.outputDtype!="float32" or args.outputCompress):
+        print("WARNING: --outputDtype/--outputCompress are ignored as they only apply to --outputFormat npz")
+        args.outputDtype, args.outputCompress = "float32", 0
+
+    if args.backend=="threads":
+        # the workqueue threading layer of numba can not run the parallel kernels launched by several threads at once
+        # and the tbb layer can hang at exit after it did. openmp handles both
+        for layer in "omp tbb".split():
+            try:
+                __import__(f"numba.np.ufunc.{layer}pool")
+                numba.config.THREADING_LAYER = layer
+                break
+            except (ImportError, OSError, ValueError):
+                continue
+        else:
+            print("WARNING: --backend threads needs the omp or tbb threading layer of numba, which is not installed. --backend processes is used instead")
+            args.backend = "processes"
+
+    # the wall time and bytes of the stages of the main process (see add_stage_time)
+    main_stages = {}
+    t = time.time()
+
+    data = image2dataframe(args.inputImage, verbose=args.verbose, extract=args.extractBox>0)
+    t = add_stage_time(main_stages, "metadata", t, os.path.getsize(args.inputImage))
 
     if args.verbose:
         if "helicaltube" in data:
@@ -69,6 +96,10 @@ def main():
     if abs(args.verbose)>0:
         print(f"Cutoff resolution: {args.cutoffRes:.4f}")
 
+    if args.fftBackend=="fft" and not all(fft_backend_supported((args.fftY, args.fftX), apix, (args.cutoffRes,)*2) for apix in data["apix"].unique()):
+        print("WARNING: --fftBackend fft needs integer fftX and fftY * cutoffRes/(2*apix). --fftBackend czt is used instead")
+        args.fftBackend = "czt"
+
     if not args.groupby:
         if abs(args.verbose)>0:
             print(f"Availabe parameters for --groupby: {data.columns.values}")
@@ -95,12 +126,35 @@ def main():
         print(f"ERROR: parameters '{' '.join(missing_attrs)}'' are not available. available parameters are '{' '.join(data)}''")
         sys.exit(-1)
 
+    compute_phase_differences = args.forcePhaseDiff or "phi0" in data
+
+    outputPrefix = args.outputPrefix or pathlib.Path(args.inputImage).stem
+    if args.groupby: outputPrefix += f".groupby-{'-'.join(args.groupby)}"
+    if args.align: outputPrefix += ".algined"
+    sumsFile = outputPrefix+".sums.npz"    # unnormalized per-group sums for incremental updates
+
+    outputLstFile = outputPrefix+ (".ps-pd.lst" if compute_phase_differences else ".ps.lst")
+    ext = ".mrcs" if args.outputFormat=="mrcs" else ""  # --outputFormat npz: folders of one .npz file per group
+    output_files = dict(ps=outputPrefix+".ps"+ext)    # power spectra
+    if compute_phase_differences:
+        output_files["pd"] = outputPrefix+".pd"+ext    # phase differences across meridian
+    if args.verbose>10:
+        output_files["image"] = outputPrefix+".avg"+ext # realspace average
+
+    if args.incremental:
+        previous = load_group_sums(sumsFile, processing_settings(args, compute_phase_differences))
+        if previous is not None:
+            data_all = data
+            data = data_all[~particle_index(data_all).isin(particle_index(previous["particles"]))]
+            if args.verbose:
+                print(f"{len(data)} new particles to add to the {previous['particles'].shape[0]} particles in {len(previous['results'])} groups saved in {sumsFile}")
+
     if args.groupby:
         groups = data.groupby(args.groupby, sort=True)
         if args.verbose:
             print(f"{len(groups)} groups based on {args.groupby}")
-        if len(groups)>1 and args.minParticles<0: args.minParticles = int(len(data)*0.01)
-        if args.minParticles>0:
+        if len(groups)>1 and args.minParticles<0 and not args.incremental: args.minParticles = int(len(data)*0.01)
+        if args.minParticles>0 and not args.incremental:  # small groups might grow with later updates. filtered after merging
             groups, groups_all = [], groups
             for gi, g in enumerate(groups_all):
                 n = len(g[1])
@@ -117,118 +171,175 @@ def main():
     else:
         groups = [("all_particles", data)]
 
-    compute_phase_differences = args.forcePhaseDiff or "phi0" in data
+    # the particles of all retained groups, tagged with their group index
+    group_keys = [g[0] for g in groups]
+    group_name_list = [format_group_name(key, args.groupby) for key in group_keys]
+    particles = pd.concat([g[1].assign(gi=gi) for gi, g in enumerate(groups)]) if len(groups) else data.assign(gi=0).iloc[:0]
+    nparticles = len(particles)
+
+    cached = None
+    if args.fourierCache:
+        if args.verbose>10:
+            print("WARNING: --fourierCache is ignored as the real space averages of --verbose>10 are not cached")
+            args.fourierCache = ""
+        elif args.checkpointDir:
+            print("WARNING: --checkpointDir is ignored as the particles of completed batches are skipped using the Fourier cache")
+            args.checkpointDir = ""
+    if args.fourierCache:
+        # the particles computed by previous runs, possibly with a different grouping, are summed from the cache
+        cache_index = open_fourier_cache(args.fourierCache, fourier_cache_settings(args))
+        particles, cached = split_cached_particles(particles, cache_index)
+        if args.verbose:
+            print(f"{len(cached)} of {len(cached)+len(particles)} particles found in the Fourier cache {args.fourierCache}")
+        t = add_stage_time(main_stages, "cache_index", t, sum(f.stat().st_size for f in pathlib.Path(args.fourierCache).glob("keys-*.npz")))
+
+    # the checkpoint signature has the requested batchSize/cpu, not the ones chosen from the currently available memory
+    signature = checkpoint_signature(args, compute_phase_differences) if args.checkpointDir else None
+    if args.batchSize<=0 and len(particles):
+        saved_plan = read_checkpoint_plan(args.checkpointDir) if args.checkpointDir else None
+        if saved_plan:
+            # a resumed run needs the same batches as the interrupted one
+            args.batchSize, args.cpu = saved_plan["batchSize"], saved_plan["cpu"]
+            if args.verbose>0:
+                print(f"batchSize={args.batchSize}, cpu={args.cpu} of the run that created {args.checkpointDir}")
+        else:
+            args.batchSize, args.cpu = choose_batch_size(args.extractBox or read_box_size(particles["filename"].iloc[0]), fft_size=(args.fftY, args.fftX), align=args.align, precision=args.precision, cpu=args.cpu, backend=args.backend, ngroups=len(group_keys), compute_phase_differences=compute_phase_differences, verbose=args.verbose)
 
-    def particle_subsets(groups, max_batch_size=args.batchSize):
-        for gi, g in enumerate(groups):
-            group_name, group_particles = g
-            if len(args.groupby)>1:
-                group_name=tuple(["%s=%s" % (attr, group_name[ai]) for ai, attr in enumerate(args.groupby)])
-            elif len(args.groupby)==1:
-                group_name=tuple(["%s=%s" % (args.groupby[0], group_name)])
-            else:
-                group_name=None
-
-            mgraphs = list(group_particles.groupby(["filename"], sort=True))
-            nptcls = [len(m[1]) for m in mgraphs]
-            batches = []
-            i0 = 0
-            while True:
-                for i in range(i0, len(nptcls)):
-                    if sum(nptcls[i0 : i+1]) >= max_batch_size or i==len(nptcls)-1:
-                        batches.append(mgraphs[i0:i+1])
-                        i0 = i+1
-                if i0>=len(nptcls)-1: break
-            for bi, batch in enumerate(batches):
-                yield batch, (gi, bi, group_name, len(groups), len(batches))
+    batches = plan_batches(particles, max_batch_size=args.batchSize, cpu=args.cpu, fft_size=(args.fftY, args.fftX), align=args.align, box_size=args.extractBox, verbose=args.verbose)
+    t = add_stage_time(main_stages, "plan", t)
 
     from joblib import Parallel, delayed
-    fftavgs = Parallel(n_jobs=args.cpu, verbose=max(0, abs(args.verbose)-2), prefer="processes")(
-        delayed(averageOneBatch)(batch, group_id, compute_phase_differences, args.diameterMask, args.cutoffRes, args.fftX, args.fftY, args.align, args.verbose) for batch, group_id in particle_subsets(groups))
-    
-    if args.verbose>0 and len(fftavgs)>1:
-        print(f"Combining results of {len(fftavgs)} tasks")
-    
-    outputPrefix = args.outputPrefix or pathlib.Path(args.inputImage).stem
-    if args.groupby: outputPrefix += f".groupby-{'-'.join(args.groupby)}"
-    if args.align: outputPrefix += ".algined"
-    outputLstFile = outputPrefix+ (".ps-pd.lst" if compute_phase_differences else ".ps.lst")
-    psFile = outputPrefix+".ps.mrcs"    # power spectra
-
-    if compute_phase_differences:
-        pdFile = outputPrefix+".pd.mrcs"    # phase differences across meridian
+    # the worker processes run the functions of the imported module (instead of __main__) so that they are pickled
+    # by reference and the per-process caches (e.g. fft_rescale plans) persist across the batches of a worker
+    this = import_this_module()
+    ntasks = 0
+    # the workers add the per-group sums of their batches to a store shared by all processes so that only the small
+    # task descriptors and batch timings are pickled between the processes. threads simply return their sums
+    # each of the cpu workers runs its numba kernels and FFTs on its share of the cores instead of all of them
+    nthreads = max(1, (os.cpu_count() or 1)//args.cpu) if args.cpu>1 else 0
+    image_size = (batches[0][0]["box_size"],)*2 if args.verbose>10 and batches else None
+    shared_sums = create_shared_sums(len(group_keys), (args.fftY, args.fftX), image_size, compute_phase_differences, args.scratchDir) if batches and args.backend=="processes" else None
+    if shared_sums is not None:
+        group_sums = open_shared_sums(shared_sums["folder"], shared_sums["names"])
     else:
-        pdFile = None
-    if args.verbose>10:
-        imageAvgFile = outputPrefix+".avg.mrcs" # realspace average
-    else:
-        imageAvgFile = None
-
-    mrc_ps = mrcfile.new_mmap(psFile, shape=(len(groups), args.fftY, args.fftX), mrc_mode=2, overwrite=True)
-    mrc_ps.voxel_size = args.cutoffRes/2
-    if compute_phase_differences:
-        mrc_pd = mrcfile.new_mmap(pdFile, shape=(len(groups), args.fftY, args.fftX), mrc_mode=2, overwrite=True)
-        mrc_pd.voxel_size = args.cutoffRes/2
-    else:
-        mrc_pd = None
-    if args.verbose>10:
-        ny, nx = fftavgs[0][2].shape
-        mrc_image = mrcfile.new_mmap(imageAvgFile, shape=(len(groups), ny, nx), mrc_mode=2, overwrite=True)
-        mrc_image.voxel_size = args.apix
-    else:
-        mrc_image = None
-
-    import pandas as pd
-    data_output = pd.DataFrame(index=list(range(len(groups))), columns="pid filename".split())
-    data_output.loc[:, "nyquist"] = args.cutoffRes
-
-    results = {}    
-    for i in range(len(fftavgs)):
-        ps_avg, pd_avg, image_avg, nptcls, group_id = fftavgs[i]
-        gi, _, group_name, _, _ = group_id
-        if group_name not in results:
-            d = {}
-            d["gi"] = gi
-            d["ps_avg"] = np.zeros_like(ps_avg)
-            if pd_avg is not None:
-                d["pd_avg"] = np.zeros_like(pd_avg)
-            if image_avg is not None:
-                d["image_avg"] = np.zeros_like(image_avg)
-            d["nptcls"] = 0
-            results[group_name] = d
-        results[group_name]["ps_avg"] += ps_avg
-        if pd_avg is not None: results[group_name]["pd_avg"] += pd_avg
-        if image_avg is not None: results[group_name]["image_avg"] += image_avg
-        results[group_name]["nptcls"] += nptcls
+        group_sums = new_group_sums(len(group_keys), (args.fftY, args.fftX), image_size, compute_phase_differences)
+    # the most expensive batches are submitted first so that the last ones to finish are short
+    subsets = sorted(batches, key=lambda b: -b[2])
+    predicted_time = {batch_id: cost for _, batch_id, cost in batches}
+    batch_time = {}
+    if args.checkpointDir:
+        # batches completed by a previous run are read back from the checkpoint folder instead of being recomputed
+        init_checkpoint_dir(args.checkpointDir, signature, plan=dict(batchSize=args.batchSize, cpu=args.cpu))
+        subsets, completed = [], subsets
+        nskipped = 0
+        for batch, batch_id, cost in completed:
+            checkpoint_file = checkpoint_batch_file(args.checkpointDir, batch_id)
+            if checkpoint_file.exists():
+                fftavg = load_batch_checkpoint(checkpoint_file)
+                if shared_sums is not None:
+                    add_to_shared_sums(shared_sums, *fftavg[:5])
+                else:
+                    add_to_group_sums(group_sums, *fftavg[:5])
+                nskipped += 1
+            else:
+                subsets.append((batch, batch_id, cost))
+        ntasks += nskipped
+        if args.verbose>0 and nskipped:
+            print(f"Skipped {nskipped} batches completed previously and saved in {args.checkpointDir}")
+    if cached is not None and len(cached):
+        t = time.time()
+        for fftavg in reduce_cached_particles(args.fourierCache, cached, (args.fftY, args.fftX), compute_phase_differences):
+            if shared_sums is not None:
+                add_to_shared_sums(shared_sums, *fftavg[:5])
+            else:
+                add_to_group_sums(group_sums, *fftavg[:5])
+        t = add_stage_time(main_stages, "cache_reduce", t, len(cached) * args.fftY * (args.fftX//2+1) * (6 if compute_phase_differences else 4))
+    # the average of a group is written as soon as the last batch with its particles is added to the sums, so that
+    # the outputs of the first groups can be inspected while the others are computed. incremental runs write the
+    # averages after merging the sums of the previous runs
+    outputs = None
+    if not args.incremental:
+        outputs = new_output_stacks(output_files, len(group_keys), (args.fftY, args.fftX), image_size, args)
+        pending = np.zeros(len(group_keys), dtype=np.int64)
+        for batch, _, _ in subsets:
+            pending[np.unique(batch["gis"])] += 1
+        final = np.flatnonzero((pending==0) & (group_sums["nptcls"]>0))
+        write_group_averages(outputs, final, group_sums, final)
+    tasks = (delayed(this.averageOneBatch)(batch, batch_id, compute_phase_differences, args.diameterMask, args.cutoffRes, args.fftX, args.fftY, args.align, args.fftBackend, args.precision, args.verbose, shared_sums=shared_sums, checkpoint_dir=args.checkpointDir, fourier_cache=args.fourierCache, nthreads=nthreads) for batch, batch_id, _ in subsets)
+    # without the shared store, the main thread adds each batch result to the group sums as soon as a worker finishes it
+    # so that the peak memory scales with the number of groups, not the number of batches
+    fftavgs = Parallel(n_jobs=args.cpu, verbose=max(0, abs(args.verbose)-2), prefer=args.backend, return_as="generator_unordered")(tasks)
+    for fftavg in fftavgs:
+        if shared_sums is None:
+            add_to_group_sums(group_sums, *fftavg[:5])
+        if outputs is not None:
+            group_ids = fftavg[0]
+            pending[group_ids] -= 1
+            final = group_ids[pending[group_ids]==0]
+            write_group_averages(outputs, final, group_sums, final)
+        batch_time[fftavg[5]] = fftavg[6]
+        ntasks += 1
+    t = add_stage_time(main_stages, "batches", t, sum(timing["stages"]["read"][1] for timing in batch_time.values()))
+    results = group_sums_results(group_sums, group_name_list)
+    
+    if args.verbose>0 and ntasks>1:
+        print(f"Combined results of {ntasks} tasks")
+    if args.verbose>0 and batch_time:
+        report_batch_times(predicted_time, batch_time, verbose=args.verbose)
 
+    # the output images are in the order of the groups
     for group_name in results:
-        gi = results[group_name]["gi"]
-        data_output.loc[gi, "pid"] = gi
-        data_output.loc[gi, "nptcls"] = results[group_name]["nptcls"]
-        if group_name:
-            data_output.loc[gi, "group"] = f"'{','.join(group_name)}'"
-        ps_avg = results[group_name]["ps_avg"] / results[group_name]["nptcls"]
-        ps_avg = np.fft.fftshift(ps_avg)
-        mrc_ps.data[gi] = ps_avg
-        if "pd_avg" in results[group_name]:
-            pd_avg = results[group_name]["pd_avg"] / results[group_name]["nptcls"]
-            pd_avg = np.rad2deg(np.arccos(pd_avg))
-            pd_avg = np.fft.fftshift(pd_avg)
-            mrc_pd.data[gi] = pd_avg
-        if "image_avg" in results[group_name]:
-            image_avg = results[group_name]["image_avg"] / results[group_name]["nptcls"]
-            mrc_image.data[gi] = image_avg
-    mrc_ps.close()
-    if mrc_pd is not None: mrc_pd.close() 
-    if mrc_image is not None: mrc_image.close() 
-
-    data_output.loc[:, "filename"] = psFile
+        results[group_name]["key"] = group_keys[results[group_name]["gi"]]
+    group_names = sorted(results, key=lambda group_name: results[group_name]["gi"])
+
+    if args.incremental:
+        particles = particle_keys(data)
+        if previous is not None:
+            results = merge_group_sums(previous["results"], results)
+            particles = pd.concat([previous["particles"], particles], ignore_index=True)
+        save_group_sums(sumsFile, results, particles, processing_settings(args, compute_phase_differences))
+        group_names = sorted(results, key=lambda group_name: group_sort_key(results[group_name]["key"]))
+        if len(group_names)>1 and args.minParticles<0: args.minParticles = int(len(particles)*0.01)
+        if args.minParticles>0:
+            ngroups_all = len(group_names)
+            group_names = [group_name for group_name in group_names if results[group_name]["nptcls"]>=args.minParticles]
+            if args.verbose and len(group_names)<ngroups_all:
+                print(f"{len(group_names)} groups after removing {ngroups_all-len(group_names)} small groups (<{args.minParticles} particles)")
+
+    t = add_stage_time(main_stages, "combine", t)
+
+    psFile, pdFile, imageAvgFile = (output_files.get(k) for k in "ps pd image".split())
+    if outputs is None:
+        if "image" in output_files and group_names:
+            image_size = results[group_names[0]]["image_avg"].shape
+        outputs = new_output_stacks(output_files, len(group_names), (args.fftY, args.fftX), image_size, args)
+        chunk = max(1, 2**19 // (args.fftY*args.fftX))
+        for g0 in range(0, len(group_names), chunk):
+            chunk_names = group_names[g0:g0+chunk]
+            arrays = {name: np.stack([results[group_name][key] for group_name in chunk_names]) for name, key in dict(nptcls="nptcls", ps="ps_avg", pd="pd_avg", image="image_avg").items() if key in results[chunk_names[0]]}
+            write_group_averages(outputs, np.arange(g0, g0+len(chunk_names)), arrays)
+        pids = np.arange(len(group_names))
+    else:
+        pids = np.array([results[group_name]["gi"] for group_name in group_names], dtype=np.int64)    # the groups were written at their group index
+    for output in outputs.values():
+        close_output_stack(output)
+
+    nptcls = np.array([results[group_name]["nptcls"] for group_name in group_names], dtype=np.int64)
+    data_output = pd.DataFrame(dict(pid=pids, filename=psFile, nptcls=nptcls))
+    if group_names and group_names[0]:
+        data_output["group"] = [f"'{','.join(group_name)}'" for group_name in group_names]
     if pdFile: data_output.loc[:, "pd"] = pdFile
     if imageAvgFile: data_output.loc[:, "avg"] = imageAvgFile
 
     cols = [c for c in "pid filename group nptcls avg pd".split() if c in data_output]
     data_output = data_output.loc[:, cols]
     dataframe2lst(data_output, outputLstFile)
+    t = add_stage_time(main_stages, "output", t, sum(output_file_size(f) for f in [psFile, pdFile, imageAvgFile, outputLstFile] if f))
+
+    if args.profile:
+        settings = processing_settings(args, compute_phase_differences)
+        settings.update(inputImage=args.inputImage, batchSize=args.batchSize, cpu=args.cpu, backend=args.backend, fftBackend=args.fftBackend)
+        save_profile(outputPrefix+".profile.json", main_stages, batch_time, settings, nparticles=nparticles, verbose=args.verbose)
     
     if args.verbose:
         if pdFile:
@@ -256,101 +367,794 @@ def main():
         query_string = get_query_string(params)
         run_hill_webapp(query_string)
 
-def averageOneBatch(mgraphs, group_id, compute_phase_differences, diameterMask, cutoff_res, pad_nx, pad_ny, align, verbose):
-    nPtcls = sum([len(m[1]) for m in mgraphs])
+def new_output_stack(filename, shape, voxel_size, dtype="float32", compress=0):
+    # the averages of the groups: a memory-mapped MRC stack, or for --outputFormat npz a folder of one .npz file per group
+    # named by the index of the group (the pid in the .lst file). each group file is complete as soon as it appears
+    # in the folder so that the groups can be read while the others are still being computed
+    if not filename.endswith(".mrcs"):
+        import shutil
+        shutil.rmtree(filename, ignore_errors=True)    # the groups of a previous run
+        pathlib.Path(filename).mkdir(parents=True)
+        return dict(folder=filename, apix=voxel_size, dtype=dtype, compress=compress)
+    mrc = mrcfile.new_mmap(filename, shape=shape, mrc_mode=2, overwrite=True)
+    mrc.voxel_size = voxel_size
+    return mrc
+
+def new_output_stacks(output_files, ngroups, fft_size, image_size, args):
+    outputs = {}
+    for name, filename in output_files.items():
+        if name=="image" and not image_size: continue   # no particles
+        shape = (ngroups, *(image_size if name=="image" else fft_size))
+        outputs[name] = new_output_stack(filename, shape, args.apix if name=="image" else args.cutoffRes/2, args.outputDtype, args.outputCompress)
+    return outputs
+
+def write_output_stack(output, pids, data):
+    # data: the averages of the groups pids
+    if not isinstance(output, dict):
+        output.data[pids] = data
+        return
+    import os, zipfile
+    for pid, image in zip(pids, data):
+        # float16 holds values up to 65504: each group is saved divided by a power of 2 (its "scale" array)
+        scale = 1.0
+        if output["dtype"]=="float16":
+            vmax = float(np.max(np.abs(image), where=np.isfinite(image), initial=0))
+            scale = 2.0**max(0, math.ceil(math.log2(max(vmax, 1)/2**15)))
+        arrays = dict(data=np.ascontiguousarray(image/scale if scale!=1 else image, dtype=output["dtype"]), scale=np.array(scale), apix=np.array(output["apix"]))
+        # written under a temporary name and renamed so that a reader never sees a partial file
+        filename = f"{output['folder']}/{pid}.npz"
+        with zipfile.ZipFile(filename+".tmp", mode="w", compression=zipfile.ZIP_DEFLATED if output["compress"] else zipfile.ZIP_STORED, compresslevel=1) as store:
+            for name, value in arrays.items():
+                with store.open(name+".npy", mode="w") as fp:
+                    np.lib.format.write_array(fp, value, allow_pickle=False)
+        os.replace(filename+".tmp", filename)
+
+def close_output_stack(output):
+    if output is not None and not isinstance(output, dict): output.close()
+
+def output_file_size(filename):
+    import os
+    if os.path.isdir(filename): return sum(f.stat().st_size for f in pathlib.Path(filename).iterdir())
+    return os.path.getsize(filename)
+
+def write_group_averages(outputs, pids, arrays, rows=None):
+    # the averages of the groups rows of the per-group sums (arrays: nptcls, ps, pd, image) are written as the groups pids
+    # of the outputs, in chunks of about 4 MB of groups so that thousands of small groups are not written one image at a time
+    rows = np.arange(len(pids)) if rows is None else np.asarray(rows)
+    pids = np.asarray(pids)
+    ny, nx = arrays["ps"].shape[-2:]
+    chunk = max(1, 2**19 // (ny*nx))
+    for c0 in range(0, len(pids), chunk):
+        r = rows[c0:c0+chunk]
+        n = arrays["nptcls"][r][:, np.newaxis, np.newaxis]
+        ps_avg = arrays["ps"][r]     # a copy
+        ps_avg /= n
+        write_output_stack(outputs["ps"], pids[c0:c0+chunk], np.fft.fftshift(ps_avg, axes=(-2, -1)))
+        if outputs.get("pd") is not None:
+            pd_avg = arrays["pd"][r]
+            pd_avg /= n
+            np.rad2deg(np.arccos(pd_avg, out=pd_avg), out=pd_avg)
+            write_output_stack(outputs["pd"], pids[c0:c0+chunk], np.fft.fftshift(pd_avg, axes=(-2, -1)))
+        if outputs.get("image") is not None:
+            image_avg = arrays["image"][r]
+            image_avg /= n
+            write_output_stack(outputs["image"], pids[c0:c0+chunk], image_avg)
+
+def format_group_name(key, groupby):
+    if len(groupby)>1:
+        return tuple(["%s=%s" % (attr, key[ai]) for ai, attr in enumerate(groupby)])
+    elif len(groupby)==1:
+        key = key[0] if isinstance(key, tuple) else key
+        return tuple(["%s=%s" % (groupby[0], key)])
+    else:
+        return None
+
+def estimate_particle_time(box_size, fft_size, align):
+    # estimated time (seconds, one thread) to process one particle, fitted to measured times:
+    # reading/rotating/tapering scale with the box area, the Fourier transforms and power/phase sums with the output size.
+    # the batch alignment adds the polar resampling and correlations, the refinement a simplex search per particle
+    t = 0.3 + 2.5e-5 * box_size**2 + 5.2e-5 * fft_size[0] * fft_size[1]
+    if align>0: t += 2.0 + 3.5e-4 * box_size**2
+    if align>1: t += 43 + 3.5e-3 * box_size**2
+    return t * 1e-3
+
+def read_box_size(filename):
+    with mrcfile.open(filename, mode=u'r', header_only=True) as mrc:
+        return int(mrc.header.nx)
+
+def estimate_particle_memory(box_size, fft_size, align, precision):
+    # estimated peak memory (bytes) per particle of a batch, fitted to measured peaks: the complex transform and
+    # its float32 power/phase scratch per output pixel, the float32 image, the complex input workspace and the
+    # chirp-z intermediates per box pixel, and the spectra/correlations of the alignment
+    c = 8 if precision=="single" else 16
+    m = (c+4) * fft_size[0] * fft_size[1] + (3.5*c+4) * box_size**2
+    if align>0: m += 8 * box_size**2
+    if align>1: m += 4 * box_size**2
+    return m
+
+def available_memory():
+    # the available system memory, or the room left under the memory limit of the cgroup (e.g. a container or a
+    # cluster job) if that is lower
+    import_with_auto_install("psutil")
+    import psutil
+    available = psutil.virtual_memory().available
+    cgroup_files = [("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current"),  # cgroup v2
+                    ("/sys/fs/cgroup/memory/memory.limit_in_bytes", "/sys/fs/cgroup/memory/memory.usage_in_bytes")]  # v1
+    for limit_file, usage_file in cgroup_files:
+        try:
+            limit = pathlib.Path(limit_file).read_text().strip()
+            usage = int(pathlib.Path(usage_file).read_text())
+        except (OSError, ValueError):
+            continue
+        if limit.isdigit(): available = min(available, int(limit)-usage)
+        break
+    return available
+
+def choose_batch_size(box_size, fft_size, align, precision, cpu, backend, ngroups=1, compute_phase_differences=True, verbose=0):
+    # the largest batch size (up to 1000) for which cpu concurrent batches fit in 80% of the available memory.
+    # the number of cpus is reduced if the memory can not hold a batch of 8 particles for each of them
+    worker_memory = 300 * 2**20     # interpreter, libraries and fft plans of one process
+    # the float32 power/phase sums of all groups in memory (new_group_sums, unless the processes share the file-backed
+    # sums of create_shared_sums) and the float64 sums of the groups of each batch, at most one new group per particle
+    nmaps = 2 if compute_phase_differences else 1
+    shared_sums = backend=="processes" and file_locks_available()
+    sums_memory = 0 if shared_sums else 4 * nmaps * fft_size[0] * fft_size[1] * ngroups
+    group_memory = 8 * nmaps * fft_size[0] * fft_size[1]
+    usable = 0.8 * available_memory()
+    budget = usable - sums_memory
+    particle_memory = estimate_particle_memory(box_size, fft_size, align, precision)
+    def batch_size_for(ncpu):
+        nprocesses = ncpu+1 if backend=="processes" and ncpu>1 else 1
+        batch_memory = (budget - worker_memory*nprocesses) / ncpu
+        n = int(batch_memory / (particle_memory+group_memory))
+        if n<=ngroups: return n
+        return int((batch_memory - ngroups*group_memory) / particle_memory)
+    ncpu = max(1, cpu)
+    while ncpu>1 and batch_size_for(ncpu)<8:
+        ncpu -= 1
+    batch_size = max(1, min(1000, batch_size_for(ncpu)))
+    if verbose>0:
+        reduced = f" (reduced from {cpu})" if ncpu<cpu else ""
+        sums = f"the sums of {ngroups} groups in the scratch folder" if shared_sums else f"{sums_memory/2**30:.2f} GB sums of {ngroups} groups"
+        print(f"Memory: {usable/2**30:.1f} GB usable - {sums}, {particle_memory/2**20:.2f} MB per particle (box={box_size}, fft={fft_size[1]}x{fft_size[0]}, {precision}, align={align}) + {group_memory/2**20:.2f} MB per group of a batch + {worker_memory/2**20:.0f} MB per process: batchSize<={batch_size}, cpu={ncpu}{reduced}")
+    if batch_size_for(ncpu)<1:
+        print(f"WARNING: even a batch of one particle does not fit in the {usable/2**30:.1f} GB usable memory with the {sums_memory/2**30:.2f} GB sums of {ngroups} groups")
+    return batch_size, ncpu
+
+def plan_batches(particles, max_batch_size, cpu, fft_size, align, box_size=0, verbose=0):
+    # micrograph-centric batches: consecutive micrographs with the particles of all groups in them, so that each
+    # micrograph is opened and read once instead of once per group. the batch size is chosen from the estimated cost
+    # so that there are several batches per cpu to keep all cpus busy till the end. large micrographs are split into
+    # equal chunks and small ones are packed together.
+    # returns [(task, (batch index, number of batches, number of groups), estimated seconds)] where task is a compact
+    # descriptor of plain arrays (see batch_task) that is cheap to pickle to the worker processes
+    import pandas as pd
+    # box_size: the size of the boxes extracted at the particle coordinates, 0 to read it from the particle stacks
+    if len(particles)==0: return []
+    box_size = box_size or read_box_size(particles["filename"].iloc[0])
+    particle_time = estimate_particle_time(box_size, fft_size, align)
+    min_batch_size = min(max_batch_size, 8)  # batches too small would waste the vectorized FFTs
+    batch_size = max_batch_size
+    if cpu>1:
+        batch_size = max(min_batch_size, min(max_batch_size, -(-len(particles) // (cpu*4))))
+
+    # after sorting, the particles of each batch are a contiguous range of rows
+    particles = particles.sort_values(["filename", "pid"], kind="stable")
+    file_codes, files = pd.factorize(particles["filename"].values, sort=True)
+    file_starts = np.searchsorted(file_codes, np.arange(len(files)+1))
+    cuts = [0]
+    n = 0
+    for fi in range(len(files)):
+        mgraph_size = file_starts[fi+1] - file_starts[fi]
+        chunk_size = -(-mgraph_size // -(-mgraph_size // batch_size))   # equal chunks of at most batch_size particles
+        for i0 in range(file_starts[fi], file_starts[fi+1], chunk_size):
+            chunk = min(chunk_size, file_starts[fi+1]-i0)
+            if n and n+chunk > batch_size:
+                cuts.append(i0)
+                n = 0
+            n += chunk
+    cuts.append(len(particles))
+
+    columns = dict(file_codes=file_codes, pids=particles["pid"].astype(int).values, gis=particles["gi"].values, apix=particles["apix"].values)
+    if "phi0" in particles: columns["phi0"] = particles["phi0"].astype(float).values
+    if "x" in particles: columns["xy"] = particles[["x", "y"]].values.astype(np.float32)
+    ngroups = int(particles["gi"].max())+1
+    nb = len(cuts)-1
+    plan = [(batch_task(files, columns, cuts[bi], cuts[bi+1], box_size), (bi, nb, ngroups), particle_time*(cuts[bi+1]-cuts[bi])) for bi in range(nb)]
+    if verbose>0:
+        total = sum(p[2] for p in plan)
+        print(f"{len(plan)} batches of <={batch_size} particles (box={box_size}, fft={fft_size[1]}x{fft_size[0]}, align={align}): estimated {particle_time*1e3:.1f} ms/particle, {total:.1f} s in total, {total/max(1, min(cpu, len(plan))):.1f} s with {cpu} cpus")
+    return plan
+
+def batch_task(files, columns, i0, i1, box_size):
+    # the particles of rows i0:i1 as a few small arrays instead of a DataFrame slice, which pickles its index,
+    # all the unused columns and a filename string per particle
+    file_codes = columns["file_codes"][i0:i1]
+    task = dict(files=[str(f) for f in files[file_codes[0]:file_codes[-1]+1]],
+                file_ids=(file_codes - file_codes[0]).astype(np.int32),
+                pids=columns["pids"][i0:i1].astype(np.int32),
+                gis=columns["gis"][i0:i1].astype(np.int32),
+                phi0=columns["phi0"][i0:i1].copy() if "phi0" in columns else None,
+                xy=columns["xy"][i0:i1] if "xy" in columns else None,     # coordinates in the micrographs
+                apix=float(columns["apix"][i0]),
+                box_size=box_size)
+    return task
+
+def report_batch_times(predicted_time, batch_time, verbose=1):
+    # compare the estimated and measured time of each batch to check the cost model
+    batch_ids = sorted(batch_time)
+    predicted = np.array([predicted_time[bid] for bid in batch_ids])
+    actual = np.array([batch_time[bid]["total"] for bid in batch_ids])
+    warmup = np.array([batch_time[bid]["warmup"] for bid in batch_ids])
+    if verbose>1:
+        for bid, p, a, w in zip(batch_ids, predicted, actual, warmup):
+            print(f"\tBatch {bid[0]+1}/{bid[1]}: estimated {p:.2f} s\tactual {a:.2f} s{' (first batch of a worker)' if w else ''}")
+    # the first batch of each worker is excluded from the statistics as it includes the one-time setup
+    ratio = (actual/np.maximum(predicted, 1e-9))[~warmup] if (~warmup).any() else actual/np.maximum(predicted, 1e-9)
+    print(f"Batch times: estimated {predicted.sum():.1f} s, actual {actual.sum():.1f} s in total. actual/estimated per batch = {np.mean(ratio):.2f} ± {np.std(ratio):.2f} (min={np.min(ratio):.2f}, max={np.max(ratio):.2f})")
+
+def add_stage_time(stages, stage, t0, nbytes=0):
+    # add the wall time since t0 and the bytes processed to a stage. returns the current time to start the next stage
+    import time
+    t = time.time()
+    seconds, total_bytes = stages.get(stage, (0.0, 0))
+    stages[stage] = (seconds + t - t0, total_bytes + int(nbytes))
+    return t
+
+def profile_stages(main_stages, batch_time, nparticles=None):
+    # one row per stage: the batch stages summed over all batches of all workers, then the stages of the main process
+    # nparticles: all particles processed by the main process if some of them (e.g. cached ones) were not in batches
+    nptcls = sum(timing["nptcls"] for timing in batch_time.values())
+    batch_stages = {}
+    for timing in batch_time.values():
+        for stage, (seconds, nbytes) in timing["stages"].items():
+            s0, b0 = batch_stages.get(stage, (0.0, 0))
+            batch_stages[stage] = (s0+seconds, b0+nbytes)
+    rows = []
+    for scope, stages, n in [("batch", batch_stages, nptcls), ("main", main_stages, nparticles or nptcls)]:
+        for stage, (seconds, nbytes) in stages.items():
+            rows.append(dict(scope=scope, stage=stage, seconds=seconds, MB=nbytes/1e6,
+                             MB_per_s=nbytes/1e6/seconds if seconds>0 else None,
+                             particles_per_s=n/seconds if seconds>0 and n else None))
+    return rows, nparticles or nptcls
+
+def save_profile(profileFile, main_stages, batch_time, settings, nparticles=None, verbose=1):
+    # the stage times as profileFile (.json) and the table of stages as a .csv next to it
+    import json
+    import pandas as pd
+    rows, nptcls = profile_stages(main_stages, batch_time, nparticles)
+    total = sum(seconds for seconds, _ in main_stages.values())
+    profile = dict(settings=settings, particles=nptcls, batches=len(batch_time), total_seconds=total,
+                   particles_per_s=nptcls/total if total>0 else None, stages=rows)
+    with open(profileFile, "w") as fp:
+        json.dump(profile, fp, indent=2, default=str)
+    table = pd.DataFrame(rows, columns="scope stage seconds MB MB_per_s particles_per_s".split())
+    table.to_csv(pathlib.Path(profileFile).with_suffix(".csv"), index=False)
     if verbose>0:
-        gi, bi, _, ng, nb = group_id
-        print(f"Group {gi+1}/{ng} - Batch {bi+1}/{nb}: {nPtcls} particles from {len(mgraphs)} micrographs")
-    phi0Angles = np.array([0.0]*nPtcls)
-    apix = mgraphs[0][1]["apix"].iloc[0]
+        print(f"Profile of {nptcls} particles in {len(batch_time)} batches: {total:.2f} s, {profile['particles_per_s'] or 0:.1f} particles/s overall. saved to {profileFile}")
+        for row in rows:
+            rate = f"\t{row['MB_per_s']:.1f} MB/s" if row["MB_per_s"] else ""
+            rate += f"\t{row['particles_per_s']:.1f} particles/s" if row["particles_per_s"] else ""
+            print(f"\t{row['scope']:5s} {row['stage']:12s}\t{row['seconds']:.3f} s\t{row['MB']:.1f} MB{rate}")
+
+def create_shared_sums(ngroups, fft_size, image_size, compute_phase_differences, scratch_dir=""):
+    # the per-group sums in memory-mapped .npy files that all worker processes add their batches to.
+    # returns a small picklable descriptor, or None if the file locks are not available on this platform
+    if not file_locks_available(): return None
+    import tempfile, shutil, atexit
+    folder = tempfile.mkdtemp(prefix="hill_power_spectra_sums_", dir=scratch_dir or None)
+    atexit.register(shutil.rmtree, folder, ignore_errors=True)
+    shapes = dict(nptcls=(ngroups,), ps=(ngroups, *fft_size))
+    if compute_phase_differences: shapes["pd"] = (ngroups, *fft_size)
+    if image_size: shapes["image"] = (ngroups, *image_size)
+    # the sparse files are filled as the groups receive particles. a full disk would kill the workers with SIGBUS
+    nbytes = sum(math.prod(shape) * (8 if name=="nptcls" else 4) for name, shape in shapes.items())
+    free = shutil.disk_usage(folder).free
+    if nbytes > free:
+        print(f"ERROR: the sums of {ngroups} groups need {nbytes/2**30:.1f} GB but {scratch_dir or tempfile.gettempdir()} only has {free/2**30:.1f} GB free. please use a larger --scratchDir")
+        sys.exit(-1)
+    for name, shape in shapes.items():
+        np.lib.format.open_memmap(f"{folder}/{name}.npy", mode="w+", dtype=np.int64 if name=="nptcls" else np.float32, shape=shape)
+    # byte gi of the lock file guards the sums of group gi
+    with open(f"{folder}/lock", "wb") as fp:
+        fp.truncate(ngroups)
+    return dict(folder=folder, names=tuple(shapes))
+
+def file_locks_available():
+    # fcntl (add_to_shared_sums) is not available on windows
+    import importlib.util
+    return importlib.util.find_spec("fcntl") is not None
+
+@lru_cache(maxsize=2)
+def open_shared_sums(folder, names):
+    return {name: np.load(f"{folder}/{name}.npy", mmap_mode="r+") for name in names}
+
+def add_to_shared_sums(shared_sums, group_ids, ps_sums, pd_sums, image_sums, nptcls):
+    import fcntl
+    arrays = open_shared_sums(shared_sums["folder"], shared_sums["names"])
+    with open(f"{shared_sums['folder']}/lock", "r+b") as fp:
+        # one lock for the range of groups of the batch. the micrograph-centric batches rarely share groups
+        # so that the batches of different workers are still added concurrently
+        g0, g1 = int(np.min(group_ids)), int(np.max(group_ids))+1
+        fcntl.lockf(fp, fcntl.LOCK_EX, g1-g0, g0)
+        try:
+            add_to_group_sums(arrays, group_ids, ps_sums, pd_sums, image_sums, nptcls)
+        finally:
+            fcntl.lockf(fp, fcntl.LOCK_UN, g1-g0, g0)
+
+def new_group_sums(ngroups, fft_size, image_size, compute_phase_differences):
+    # the in-memory counterpart of the arrays of create_shared_sums. the batch sums (float64) are accumulated
+    # at the float32 precision of the outputs
+    arrays = dict(nptcls=np.zeros(ngroups, dtype=np.int64), ps=np.zeros((ngroups, *fft_size), dtype=np.float32))
+    if compute_phase_differences: arrays["pd"] = np.zeros((ngroups, *fft_size), dtype=np.float32)
+    if image_size: arrays["image"] = np.zeros((ngroups, *image_size), dtype=np.float32)
+    return arrays
+
+def add_to_group_sums(arrays, group_ids, ps_sums, pd_sums, image_sums, nptcls):
+    # the per-group sums of a batch, stacked in the order of group_ids (unique), are added to the sums of all groups
+    sums = dict(nptcls=nptcls, ps=ps_sums, pd=pd_sums, image=image_sums)
+    # the groups of a micrograph-centric batch are usually consecutive: add in place to a slice instead of a gathered copy
+    g0 = int(group_ids[0])
+    consecutive = np.array_equal(group_ids, np.arange(g0, g0+len(group_ids)))
+    for name, array in arrays.items():
+        if consecutive:
+            array[g0:g0+len(group_ids)] += sums[name]
+        else:
+            for k, gi in enumerate(group_ids):
+                array[gi] += sums[name][k]
+
+def group_sums_results(arrays, group_name_list):
+    # {group name: dict(gi, nptcls, ps_avg, pd_avg, image_avg)} of the groups with particles. the sums are views of arrays
+    keys = dict(ps="ps_avg", pd="pd_avg", image="image_avg")
+    results = {}
+    for gi in np.flatnonzero(arrays["nptcls"]>0):
+        d = dict(gi=int(gi), nptcls=int(arrays["nptcls"][gi]))
+        for name, key in keys.items():
+            if name in arrays: d[key] = arrays[name][gi]
+        results[group_name_list[gi]] = d
+    return results
+
+def processing_settings(args, compute_phase_differences):
+    # the settings that the per-particle power spectra/phase differences depend on
+    settings = {attr: getattr(args, attr) for attr in "groupby apix diameterMask cutoffRes fftX fftY precision align".split()}
+    if args.extractBox: settings["extractBox"] = args.extractBox
+    settings["apix"] = float(settings["apix"])
+    settings["cutoffRes"] = float(settings["cutoffRes"])
+    settings["phaseDiff"] = bool(compute_phase_differences)
+    return settings
+
+def checkpoint_signature(args, compute_phase_differences):
+    # the batches saved in a checkpoint folder are only reusable by a run with the same input and settings
+    input_stat = pathlib.Path(args.inputImage).stat()
+    signature = dict(inputImage=str(pathlib.Path(args.inputImage).resolve()), inputSize=input_stat.st_size, inputMtime=input_stat.st_mtime)
+    signature.update(processing_settings(args, compute_phase_differences))
+    signature["minParticles"] = args.minParticles
+    signature["batchSize"] = args.batchSize
+    signature["cpu"] = args.cpu     # the batch size is chosen for the number of cpus
+    return signature
+
+def init_checkpoint_dir(checkpoint_dir, signature, plan=None):
+    # plan: the batchSize/cpu used to plan the batches, saved for the automatic batch size of a resumed run
+    import json
+    checkpoint_dir = pathlib.Path(checkpoint_dir)
+    checkpoint_dir.mkdir(parents=True, exist_ok=True)
+    signature_file = checkpoint_dir / "checkpoint.json"
+    if signature_file.exists():
+        saved = json.loads(signature_file.read_text())
+        saved.pop("plan", None)
+        if saved != signature:
+            changed = [k for k in sorted(set(saved) | set(signature)) if saved.get(k) != signature.get(k)]
+            print(f"ERROR: checkpoint folder {checkpoint_dir} was created by a run with different {' '.join(changed)}. please use a new checkpoint folder")
+            sys.exit(-1)
+    else:
+        signature_file.write_text(json.dumps(dict(signature, plan=plan) if plan else signature, indent=1))
+
+def read_checkpoint_plan(checkpoint_dir):
+    import json
+    signature_file = pathlib.Path(checkpoint_dir) / "checkpoint.json"
+    if not signature_file.exists(): return None
+    return json.loads(signature_file.read_text()).get("plan")
+
+def checkpoint_batch_file(checkpoint_dir, batch_id):
+    bi, _, _ = batch_id
+    return pathlib.Path(checkpoint_dir) / f"batch-{bi:06d}.npz"
+
+def save_batch_checkpoint(checkpoint_dir, fftavg):
+    import os
+    group_ids, ps_sums, pd_sums, image_sums, nptcls, batch_id = fftavg[:6]
+    arrays = dict(group_ids=group_ids, ps_sums=ps_sums, nptcls=nptcls, batch_id=batch_id)
+    if pd_sums is not None: arrays["pd_sums"] = pd_sums
+    if image_sums is not None: arrays["image_sums"] = image_sums
+    # write to a temporary file first so that an interrupted run never leaves a truncated batch behind
+    checkpoint_file = checkpoint_batch_file(checkpoint_dir, batch_id)
+    tmp_file = checkpoint_file.with_suffix(".tmp")
+    with open(tmp_file, "wb") as fp:
+        np.savez(fp, **arrays)
+    os.replace(tmp_file, checkpoint_file)
+
+def load_batch_checkpoint(checkpoint_file):
+    with np.load(checkpoint_file) as f:
+        pd_sums = f["pd_sums"] if "pd_sums" in f else None
+        image_sums = f["image_sums"] if "image_sums" in f else None
+        return f["group_ids"], f["ps_sums"], pd_sums, image_sums, f["nptcls"], tuple(int(i) for i in f["batch_id"]), {}
+
+def particle_keys(particles):
+    # the identity of each particle: its file and index in the file, or for the particles cut from the micrographs
+    # (--extractBox) the micrograph and the coordinates, as their pid is only their order in the meta data file
+    import pandas as pd
+    keys = dict(filename=particles["filename"].astype(str).values)
+    if "x" in particles:
+        keys["x"] = coordinate_keys(particles["x"].values)
+        keys["y"] = coordinate_keys(particles["y"].values)
+    else:
+        keys["pid"] = particles["pid"].astype(int).values
+    return pd.DataFrame(keys, index=particles.index)
+
+def coordinate_keys(values):
+    # rounded from float32, the precision of the coordinates sent to the workers
+    return np.asarray(values, dtype=np.float32).astype(np.float64).round(2)
+
+def particle_index(particles):
+    import pandas as pd
+    return pd.MultiIndex.from_frame(particle_keys(particles))
+
+def group_sort_key(key):
+    return key if isinstance(key, tuple) else (key,)
+
+def merge_group_sums(results, new_results):
+    merged = dict(results)
+    for group_name, d in new_results.items():
+        if group_name in merged:
+            m = dict(merged[group_name])
+            for k in "ps_avg pd_avg image_avg".split():
+                if k in d and k in m: m[k] = m[k] + d[k]
+            m["nptcls"] += d["nptcls"]
+            merged[group_name] = m
+        else:
+            merged[group_name] = d
+    return merged
+
+def save_group_sums(sumsFile, results, particles, settings):
+    # unnormalized sums so that the particles of later runs can simply be added to them
+    import json, os
+    group_names = list(results)
+    arrays = dict(settings=json.dumps(settings))
+    arrays["group_names"] = np.array([json.dumps(group_name) for group_name in group_names])
+    arrays["group_keys"] = np.array([json.dumps(list(group_sort_key(results[group_name]["key"])), default=lambda v: v.item()) for group_name in group_names])
+    arrays["nptcls"] = np.array([results[group_name]["nptcls"] for group_name in group_names], dtype=np.int64)
+    for k in "ps_avg pd_avg image_avg".split():
+        if group_names and k in results[group_names[0]]:
+            arrays[k] = np.stack([results[group_name][k] for group_name in group_names])
+    # particles: see particle_keys
+    arrays["particle_filenames"] = particles["filename"].values.astype(str)
+    if "x" in particles:
+        arrays["particle_x"], arrays["particle_y"] = particles["x"].values, particles["y"].values
+    else:
+        arrays["particle_pids"] = particles["pid"].astype(np.int64).values
+    tmp_file = sumsFile + ".tmp"
+    with open(tmp_file, "wb") as fp:
+        np.savez(fp, **arrays)
+    os.replace(tmp_file, sumsFile)
+
+def load_group_sums(sumsFile, settings):
+    import json
+    import pandas as pd
+    if not pathlib.Path(sumsFile).exists(): return None
+    with np.load(sumsFile) as f:
+        saved = json.loads(str(f["settings"]))
+        if saved != settings:
+            changed = [k for k in sorted(set(saved) | set(settings)) if saved.get(k) != settings.get(k)]
+            print(f"ERROR: {sumsFile} was created with different {' '.join(changed)}. please use a different --outputPrefix or the same settings")
+            sys.exit(-1)
+        results = {}
+        for i, group_name in enumerate(f["group_names"]):
+            group_name = json.loads(str(group_name))
+            group_name = tuple(group_name) if group_name is not None else None
+            key = json.loads(str(f["group_keys"][i]))
+            d = dict(gi=i, key=tuple(key) if len(key)>1 else key[0], nptcls=int(f["nptcls"][i]))
+            for k in "ps_avg pd_avg image_avg".split():
+                if k in f: d[k] = f[k][i]
+            results[group_name] = d
+        if "particle_x" in f:
+            particles = pd.DataFrame(dict(filename=f["particle_filenames"], x=f["particle_x"], y=f["particle_y"]))
+        else:
+            particles = pd.DataFrame(dict(filename=f["particle_filenames"], pid=f["particle_pids"]))
+    return dict(results=results, particles=particles)
+
+def averageOneBatch(task, batch_id, compute_phase_differences, diameterMask, cutoff_res, pad_nx, pad_ny, align, fft_backend, precision, verbose, shared_sums=None, checkpoint_dir="", fourier_cache="", nthreads=0):
+    # task: the files, per-particle file index, pid, group index and phi0 of the batch (see batch_task)
+    # nthreads: the threads of the numba kernels and FFTs of this worker, 0 for all cores
+    import time
+    t_start = time.time()
+    stages = {}
+    files = task["files"]
+    pids = task["pids"]
+    nPtcls = len(pids)
+    group_ids, group_index = np.unique(task["gis"], return_inverse=True)
+    if nthreads:
+        numba.set_num_threads(min(nthreads, numba.config.NUMBA_NUM_THREADS))   # for the calling thread only
+    if verbose>0:
+        bi, nb, ng = batch_id
+        print(f"Batch {bi+1}/{nb}: {nPtcls} particles of {len(group_ids)}/{ng} groups from {len(files)} micrographs")
+    phi0Angles = np.zeros(nPtcls) if task["phi0"] is None else task["phi0"].astype(np.float64)
+    apix = task["apix"]
     tapering_filter = None
     data_orig = None
     data_in = None
-    i0 = 0
-    for mgraph in mgraphs:
-        _, particles = mgraph
-        n = len(particles)
-        pids = particles["pid"].astype(int).values
-        filename = particles["filename"].iloc[0]
+    file_starts = np.searchsorted(task["file_ids"], np.arange(len(files)+1))
+    for fi, filename in enumerate(files):
+        i0, i1 = file_starts[fi], file_starts[fi+1]
         with mrcfile.mmap(filename, mode='r') as mrc:
-            ny, nx = mrc.data.shape[-2:]
+            ny, nx = (task["box_size"],)*2 if task["xy"] is not None else mrc.data.shape[-2:]
             assert ny==nx, f"Error in reading {filename}: {mrc.data.shape}"
             if data_orig is None:
                 data_orig = np.zeros((nPtcls, ny, nx), dtype=np.float32)
-                if align:
-                    data_in = np.zeros((nPtcls, ny, nx), dtype=np.float32)
-                else:
-                    data_in = data_orig
             if tapering_filter is None:
                 if diameterMask > 0:
                     fraction_x = diameterMask/apix / nx
                 else:
                     fraction_x = 0.9
-                tapering_filter = generate_tapering_filter(image_size=(ny, nx), fraction_start=[0.9, fraction_x], fraction_slope=0.1)
+                tapering_filter = generate_tapering_filter(image_size=(ny, nx), fraction_start=[0.9, fraction_x], fraction_slope=0.1).astype(np.float32)
 
-            if "phi0" in particles:
-                phi0Angles[i0:i0+n] = particles["phi0"].astype(float).values
-
-            for i in range(n):
-                data_orig[i0+i] = mrc.data[pids[i]]
-        i0 += n
+            if task["xy"] is not None:
+                extract_particles(mrc.data, task["xy"][i0:i1], out=data_orig[i0:i1])
+            else:
+                read_particles(mrc.data, pids[i0:i1], out=data_orig[i0:i1])
+    data_in = data_orig     # rotations and masks are applied in place
+    t = add_stage_time(stages, "read", t_start, data_orig.nbytes)
 
     if align:
-        da = np.zeros(nPtcls)
-        dxy = np.zeros(nPtcls)
-        for pi in range(nPtcls):
-            d = data_orig[pi]
-            dphi = - phi0Angles[pi]
-            d_aligned, da[pi], dxy[pi] = rotation_trans_align(image=d, angle0=dphi, dx0=0, dy0=0, mask=tapering_filter)
-            data_in[pi] = d_aligned * tapering_filter
+        t0 = time.time()
+        da, dxy = align_images(data_in, angle0=-phi0Angles, mask=tapering_filter, refine=align>1, workers=nthreads or -1)
+        data_in *= tapering_filter
         if verbose>1:
-            gi, bi, _, ng, nb = group_id
-            print(f"Group {gi+1}/{ng} - Batch {bi+1}/{nb}: mean rotation = {np.mean(np.abs(da)):.2f}°\t shift = {np.mean(np.abs(dxy))*apix:.1f}Å")
+            bi, nb, _ = batch_id
+            print(f"Batch {bi+1}/{nb}: mean rotation = {np.mean(np.abs(da)):.2f}°\t shift = {np.mean(np.abs(dxy))*apix:.1f}Å\t {nPtcls/(time.time()-t0):.1f} particles/s")
+        t = add_stage_time(stages, "align", t, data_in.nbytes)
     else:
-        for pi in range(nPtcls):
-            d = data_orig[pi]
-            dphi = - phi0Angles[pi]
-            if dphi != 0:
-                d_rotated = rotate_shift_image(data=d, angle=dphi, post_shift=(0, 0))
-            else:
-                d_rotated = d
-            data_in[pi] = d_rotated * tapering_filter
+        rotate_shift_images(data_in, angles=-phi0Angles, taper=tapering_filter, out=data_in)
+        t = add_stage_time(stages, "rotate", t, data_in.nbytes)
 
-    ps_avg = np.zeros((pad_ny, pad_nx), dtype=np.float32)
-    if compute_phase_differences:
-        pd_avg = np.zeros((pad_ny, pad_nx), dtype=np.float32)
-    if verbose>10:
-        _, ny, nx = data_in.shape
-        image_avg = np.zeros((ny, nx), dtype=np.float32)
-    
-    data_fft = fft_rescale(images=data_in, apix=apix, cutoff_res=(cutoff_res, cutoff_res), output_size=(pad_ny, pad_nx))
-    amp = np.abs(data_fft)
-    amp *= amp
-    ps_avg = np.sum(amp, axis=0)
+    data_fft = fft_rescale(images=data_in, apix=apix, cutoff_res=(cutoff_res, cutoff_res), output_size=(pad_ny, pad_nx), backend=fft_backend, precision=precision, nthreads=nthreads)
+    t = add_stage_time(stages, "fft_rescale", t, data_fft.nbytes)
 
-    if compute_phase_differences:
-        phase = np.angle(data_fft)
-        cos = compute_phase_difference_across_meridian(phase, compute_cosine=True)
-        pd_avg = np.sum(cos, axis=0)
-    else:
-        pd_avg = None
+    if fourier_cache:
+        filenames = np.array(files)[task["file_ids"]]
+        nbytes = save_fourier_cache_chunk(fourier_cache, filenames, pids, phi0Angles, data_fft, xy=task["xy"])
+        t = add_stage_time(stages, "cache", t, nbytes)
 
+    # the sums of each group in this batch: each particle is added to the sums of its group in one pass over the batch
+    # regardless of the number of groups
+    ps_sums, pd_sums = sum_power_and_phase_difference_across_meridian(data_fft, compute_phase_differences, group_index=group_index, ngroups=len(group_ids))
+    image_sums = None
     if verbose>10:
-        image_avg = np.sum(data_in, axis=0)
+        image_sums = np.zeros((len(group_ids),) + data_in.shape[1:])
+        np.add.at(image_sums, group_index, data_in)
+    nptcls = np.bincount(group_index, minlength=len(group_ids))
+    t = add_stage_time(stages, "reduce", t, data_fft.nbytes)
+
+    fftavg = (group_ids, ps_sums, pd_sums, image_sums, nptcls, batch_id)
+    if checkpoint_dir:
+        save_batch_checkpoint(checkpoint_dir, fftavg)
+    if shared_sums is not None:
+        # the sums go to the shared store directly instead of being pickled back to the main process
+        add_to_shared_sums(shared_sums, *fftavg[:5])
+        fftavg = (group_ids, None, None, None, nptcls, batch_id)
+    if checkpoint_dir or shared_sums is not None:
+        t = add_stage_time(stages, "store", t, sum(a.nbytes for a in (ps_sums, pd_sums, image_sums) if a is not None))
+
+    # the first batch of a worker also pays for the one-time numba compilation and fft plans
+    import threading
+    workers = averageOneBatch.__dict__.setdefault("workers", set())
+    timing = dict(total=time.time()-t_start, warmup=threading.get_ident() not in workers, nptcls=nPtcls, stages=stages)
+    workers.add(threading.get_ident())
+    return fftavg + (timing,)
+
+def read_particles(data, pids, out):
+    # copy data[pids] into out with one slice read per contiguous run of the sorted pids
+    # instead of one read per particle. data can be a memory-mapped mrc stack
+    order = np.argsort(pids, kind="stable")
+    sorted_pids = pids[order]
+    breaks = np.nonzero(np.diff(sorted_pids) != 1)[0] + 1
+    starts = np.concatenate(([0], breaks))
+    ends = np.concatenate((breaks, [len(pids)]))
+    for s, e in zip(starts, ends):
+        out[order[s:e]] = data[sorted_pids[s]:sorted_pids[e-1]+1]
+    return out
+
+def extract_particles(micrograph, xy, out):
+    # cut the boxes of out.shape[-2:] centered at the (x, y) pixel coordinates from a (memory-mapped) micrograph.
+    # the parts of the boxes outside of the micrograph are filled with the mean of the rest of the box
+    # and the mean of each box is subtracted like in the particle stacks extracted by relion/cryosparc
+    micrograph = micrograph.reshape(micrograph.shape[-2:])
+    mny, mnx = micrograph.shape
+    ny, nx = out.shape[-2:]
+    for i, (x, y) in enumerate(xy):
+        x0 = int(round(x)) - nx//2
+        y0 = int(round(y)) - ny//2
+        sx0, sy0 = max(0, x0), max(0, y0)
+        sx1, sy1 = min(mnx, x0+nx), min(mny, y0+ny)
+        if sx1<=sx0 or sy1<=sy0:
+            out[i] = 0
+            continue
+        box = micrograph[sy0:sy1, sx0:sx1]
+        mean = box.mean(dtype=np.float64)
+        if box.shape != (ny, nx): out[i] = mean
+        out[i, sy0-y0:sy1-y0, sx0-x0:sx1-x0] = box
+        out[i] -= mean
+    return out
+
+def sum_power_and_phase_difference_across_meridian(fft, compute_phase_differences=True, group_index=None, ngroups=1):
+    # sums of the power spectra and of the cosine of the phase differences across meridian over a stack of Fourier transforms
+    # cos(phase differences) = Re(F * conj(F_mirror)) / (|F| * |F_mirror|) is computed directly from the complex values
+    # group_index: the group (0..ngroups-1) of each transform. the sums of all groups are returned as (ngroups, ny, nx) float64 arrays
+    fft = np.ascontiguousarray(fft)
+    if fft.ndim == 2: fft = fft[np.newaxis]
+    n, ny, nx = fft.shape
+    grouped = group_index is not None
+    group_index = np.zeros(n, dtype=np.int64) if group_index is None else np.asarray(group_index, dtype=np.int64)
+    ps = np.zeros((ngroups, ny, nx))
+    pd = np.zeros((ngroups, ny, nx)) if compute_phase_differences else np.zeros((0, 0, 0))
+    _sum_power_and_phase_difference_across_meridian(fft, group_index, ps, pd, compute_phase_differences)
+    if compute_phase_differences:
+        pd[:, :, 0] = np.bincount(group_index, minlength=ngroups)[:, np.newaxis]   # zero phase difference (cosine=1)
+    if not grouped:
+        real_dtype = np.float32 if fft.dtype == np.complex64 else np.float64
+        return ps[0].astype(real_dtype), (pd[0].astype(real_dtype) if compute_phase_differences else None)
+    return ps, (pd if compute_phase_differences else None)
+
+@numba.jit(nopython=True, cache=True, nogil=True, parallel=True)
+def _sum_power_and_phase_difference_across_meridian(fft, group_index, ps, pd, compute_phase_differences):
+    # single pass over fft (n, ny, nx) in the np.fft.fftfreq layout: the mirror of column ix is column nx-ix.
+    # transform i is added to the sums of group group_index[i]. the threads own whole rows of all groups
+    n, ny, nx = fft.shape
+    for iy in numba.prange(ny):
+        for i in range(n):
+            g = group_index[i]
+            for ix in range(nx):
+                a = fft[i, iy, ix]
+                a2 = a.real*a.real + a.imag*a.imag
+                ps[g, iy, ix] += a2
+                if compute_phase_differences and ix>0:
+                    b = fft[i, iy, nx-ix]
+                    d = np.sqrt(a2 * (b.real*b.real + b.imag*b.imag))
+                    if d>0:
+                        pd[g, iy, ix] += (a.real*b.real + a.imag*b.imag) / d
+                    else:
+                        pd[g, iy, ix] += 1.0
+
+def power_and_phase_difference_across_meridian(fft):
+    # the power spectra and the cosines of the phase differences across meridian of each Fourier transform in a stack,
+    # only for the columns 0..nx//2 as both are centrosymmetric for real images (see expand_half_spectra)
+    fft = np.ascontiguousarray(fft)
+    if fft.ndim == 2: fft = fft[np.newaxis]
+    n, ny, nx = fft.shape
+    ps = np.empty((n, ny, nx//2+1), dtype=np.float32)
+    pd = np.empty((n, ny, nx//2+1), dtype=np.float32)
+    _power_and_phase_difference_across_meridian(fft, ps, pd)
+    return ps, pd
+
+@numba.jit(nopython=True, cache=True, nogil=True, parallel=True)
+def _power_and_phase_difference_across_meridian(fft, ps, pd):
+    # the per-particle terms of _sum_power_and_phase_difference_across_meridian
+    n, ny, nx = fft.shape
+    nh = ps.shape[-1]
+    for i in numba.prange(n):
+        for iy in range(ny):
+            for ix in range(nh):
+                a = fft[i, iy, ix]
+                a2 = a.real*a.real + a.imag*a.imag
+                ps[i, iy, ix] = a2
+                pd[i, iy, ix] = 1.0
+                if ix>0:
+                    b = fft[i, iy, nx-ix]
+                    d = np.sqrt(a2 * (b.real*b.real + b.imag*b.imag))
+                    if d>0:
+                        pd[i, iy, ix] = (a.real*b.real + a.imag*b.imag) / d
+
+def expand_half_spectra(half, nx):
+    # the full (..., ny, nx) maps in the np.fft.fftfreq layout from the columns 0..nx//2 of centrosymmetric maps:
+    # map[iy, ix] = map[-iy, nx-ix]
+    ny, nh = half.shape[-2:]
+    full = np.empty(half.shape[:-1] + (nx,), dtype=half.dtype)
+    full[..., :nh] = half
+    full[..., nh:] = half[..., (-np.arange(ny)) % ny, :][..., nx - np.arange(nh, nx)]
+    return full
+
+def fourier_cache_settings(args):
+    # the settings that the cached per-particle maps depend on. unlike the group sums, not the grouping
+    settings = processing_settings(args, compute_phase_differences=True)
+    del settings["groupby"], settings["phaseDiff"]
+    return settings
+
+def fourier_cache_keys(particles):
+    # the particles are identified by their (resolved) file, index in the file (or coordinates, see particle_keys)
+    # and in-plane angle. the cache settings have the --extractBox of the extracted particles
+    keys = particle_keys(particles)
+    keys["phi0"] = particles["phi0"].astype(float).round(3).values if "phi0" in particles else np.zeros(len(particles))
+    return keys
+
+def open_fourier_cache(cache_dir, settings):
+    # the index of the particles in the cache folder: the chunk and row of each key. the folder is created if needed
+    import json
+    import pandas as pd
+    cache_dir = pathlib.Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    settings_file = cache_dir / "cache.json"
+    if settings_file.exists():
+        saved = json.loads(settings_file.read_text())
+        if saved != settings:
+            changed = [k for k in sorted(set(saved) | set(settings)) if saved.get(k) != settings.get(k)]
+            print(f"ERROR: the Fourier cache {cache_dir} was created with different {' '.join(changed)}. please use a different folder or the same settings")
+            sys.exit(-1)
     else:
-        image_avg = None
-
-    return (ps_avg, pd_avg, image_avg, nPtcls, group_id)
-
-def compute_phase_difference_across_meridian(phase, compute_cosine=False):
-    # https://numpy.org/doc/stable/reference/generated/numpy.fft.fftfreq.html
-    phase_diff = phase * 0
-    phase_diff[..., 1:] = phase[..., 1:] - phase[..., 1:][..., ::-1]
-    if compute_cosine:
-        phase_diff = np.cos(phase_diff)
-    return phase_diff
-
-def fft_rescale(images, apix=1.0, cutoff_res=None, output_size=None):
+        settings_file.write_text(json.dumps(settings, indent=2))
+    key_columns = ["x", "y"] if settings.get("extractBox") else ["pid"]
+    chunks = []
+    for keys_file in sorted(cache_dir.glob("keys-*.npz")):
+        with np.load(keys_file) as f:
+            keys = {"filename": f["filenames"]}
+            if "x" in key_columns: keys.update(x=f["x"], y=f["y"])
+            else: keys["pid"] = f["pids"]
+            chunks.append(pd.DataFrame(dict(keys, phi0=f["phi0"], chunk=keys_file.stem[len("keys-"):], row=np.arange(len(f["phi0"])))))
+    if not chunks:
+        dtypes = [("filename", object)] + [(c, int if c=="pid" else float) for c in key_columns] + [("phi0", float), ("chunk", object), ("row", int)]
+        return pd.DataFrame({c: pd.Series(dtype=t) for c, t in dtypes})
+    return pd.concat(chunks, ignore_index=True).drop_duplicates(["filename", *key_columns, "phi0"])
+
+def split_cached_particles(particles, cache_index):
+    # returns (the particles to compute, the cached particles with their chunk and row)
+    keys = fourier_cache_keys(particles)
+    found = keys.reset_index().merge(cache_index, on=list(keys.columns), how="inner").set_index("index")
+    cached = particles.loc[found.index].assign(chunk=found["chunk"].values, row=found["row"].values)
+    return particles.drop(index=found.index), cached
+
+def save_fourier_cache_chunk(cache_dir, filenames, pids, phi0, fft, xy=None):
+    # the power spectra (float32) and phase difference cosines (float16) of a batch as a new chunk of the cache.
+    # the keys file is written last so that an interrupted write never leaves a chunk that looks complete
+    import os, uuid
+    ps, pd_cos = power_and_phase_difference_across_meridian(fft)
+    chunk = uuid.uuid4().hex
+    arrays = {f"ps-{chunk}.npy": ps, f"pd-{chunk}.npy": pd_cos.astype(np.float16)}
+    for name, array in arrays.items():
+        tmp_file = pathlib.Path(cache_dir) / (name + ".tmp")
+        with open(tmp_file, "wb") as fp:
+            np.save(fp, array)
+        os.replace(tmp_file, pathlib.Path(cache_dir) / name)
+    tmp_file = pathlib.Path(cache_dir) / f"keys-{chunk}.npz.tmp"
+    with open(tmp_file, "wb") as fp:
+        keys = dict(filenames=np.asarray(filenames).astype(str), pids=np.asarray(pids, dtype=np.int64), phi0=np.asarray(phi0, dtype=np.float64).round(3))
+        if xy is not None: keys.update(x=coordinate_keys(xy[:, 0]), y=coordinate_keys(xy[:, 1]))   # see particle_keys
+        np.savez(fp, **keys)
+    os.replace(tmp_file, pathlib.Path(cache_dir) / f"keys-{chunk}.npz")
+    return ps.nbytes + pd_cos.nbytes//2
+
+def reduce_cached_particles(cache_dir, cached, fft_size, compute_phase_differences):
+    # the per-group sums of the cached particles, one chunk at a time, in the form of the averageOneBatch results
+    _, nx = fft_size
+    for chunk, rows in cached.groupby("chunk", sort=True):
+        ps = np.load(pathlib.Path(cache_dir) / f"ps-{chunk}.npy", mmap_mode="r")
+        pd_cos = np.load(pathlib.Path(cache_dir) / f"pd-{chunk}.npy", mmap_mode="r") if compute_phase_differences else None
+        group_ids, group_index = np.unique(rows["gi"].values, return_inverse=True)
+        ps_sums = np.zeros((len(group_ids),) + ps.shape[1:])
+        pd_sums = np.zeros((len(group_ids),) + ps.shape[1:]) if compute_phase_differences else None
+        for k in range(len(group_ids)):
+            sel = np.sort(rows["row"].values[group_index==k])
+            ps_sums[k] = ps[sel].sum(axis=0, dtype=np.float64)
+            if compute_phase_differences: pd_sums[k] = pd_cos[sel].sum(axis=0, dtype=np.float64)
+        nptcls = np.bincount(group_index, minlength=len(group_ids))
+        yield (group_ids, expand_half_spectra(ps_sums, nx), expand_half_spectra(pd_sums, nx) if compute_phase_differences else None, None, nptcls)
+
+def fft_rescale(images, apix=1.0, cutoff_res=None, output_size=None, backend="auto", precision="double", chunk=16, nthreads=0):
+    # backend: nufft - non-uniform FFT (finufft), accurate to the requested eps=1e-6
+    #          czt   - chirp-z/zoom FFT along each axis, exact to double precision round-off
+    #          fft   - zero-pad (or fold) to the FFT size whose grid contains the target frequencies, exact
+    #          auto  - fft if the target grid is a sub-grid of an affordable FFT, otherwise czt
+    # precision: double (complex128) or single (complex64) for the whole transform and the output
+    # chunk: number of images per transform of the cached plan
+    # nthreads: the threads of the finufft plan, 0 for all cores
+    # czt/fft agree with each other to round-off and with nufft to the finufft eps=1e-6, which bounds the relative l2 error:
+    # the max error is ~1.2e-6 of the max amplitude. tests/test_hill_power_spectra.py checks <5e-6
     assert(len(images.shape) in [2, 3])
 
     if cutoff_res:
@@ -360,44 +1164,242 @@ def fft_rescale(images, apix=1.0, cutoff_res=None, output_size=None):
     if output_size:
         ony, onx = output_size
     else:
-        ony, onx = images.shape
-
-    freq_y = np.fft.fftfreq(ony) * 2*apix/cutoff_res_y
-    freq_x = np.fft.fftfreq(onx) * 2*apix/cutoff_res_x
-    Y, X = np.meshgrid(freq_y, freq_x, indexing='ij')
-    Y = (2*np.pi * Y).flatten(order='C')
-    X = (2*np.pi * X).flatten(order='C')
-
-    images_work = images
-    if len(images.shape) == 3:
-        n = images.shape[0]
-        if n==1:
-            images_work = images[0]
-    else:
-        n = 1
-
-    from finufft import nufft2d2
-    fft = nufft2d2(x=Y, y=X, f=images_work.astype(np.complex), eps=1e-6)
-    if n>1:
-        fft = fft.reshape((n, ony, onx))
-
+        ony, onx = images.shape[-2:]
+
+    stack = images if len(images.shape) == 3 else images[np.newaxis]
+    n, ny, nx = stack.shape
+
+    # the plans only depend on the image geometry so that the batches of any length reuse them.
+    # the finufft plan transforms a fixed number of images (chunk) at a time. the last chunk of a stack is padded
+    # with the stale images of the workspace
+    chunk = min(n, chunk)
+    plan = get_fft_rescale_plan((ny, nx), (ony, onx), float(apix), (float(cutoff_res_y), float(cutoff_res_x)), backend, precision, chunk, nthreads)
+    if plan["backend"] == "nufft":
+        work = plan["input"]
+        fft = np.empty((n, ony, onx), dtype=work.dtype)
+        for i0 in range(0, n, chunk):
+            m = min(chunk, n-i0)
+            np.copyto(work[:m], stack[i0:i0+m])
+            out = fft[i0:i0+chunk].reshape(chunk, ony*onx) if m==chunk else None
+            out = plan["nufft"].execute(work, out=out)
+            if m<chunk: fft[i0:] = out[:m].reshape(m, ony, onx)
         # phase shifts for real-space shifts by half of the image box in both directions
-        phase_shift = np.ones(fft.shape)
-        phase_shift[:, 1::2, :] *= -1
-        phase_shift[:, :, 1::2] *= -1
-        fft *= phase_shift
+        fft *= plan["phase_shift"]
     else:
-        fft = fft.reshape((ony, onx))
+        # separable transforms: along x first, then along y. the half box phase shifts are included in the plans
+        fft = zoom_dft(stack.astype(plan["dtype"]), plan["x"], axis=-1)
+        fft = zoom_dft(fft, plan["y"], axis=-2)
+    if len(images.shape) == 2:
+        fft = fft[0]
+    # now fft has the same layout and phase origin (i.e. np.fft.ifft2(fft) would obtain original image)
+    return fft
 
-        # phase shifts for real-space shifts by half of the image box in both directions
-        phase_shift = np.ones(fft.shape)
+def get_fft_rescale_plan(*key):
+    # a plan cache per thread as a finufft plan and the input workspace can only be used by one thread at a time
+    import threading
+    local = get_fft_rescale_plan.__dict__.setdefault("local", threading.local())
+    if not hasattr(local, "plans"):
+        local.plans = lru_cache(maxsize=8)(make_fft_rescale_plan)
+    return local.plans(*key)
+
+def make_fft_rescale_plan(image_shape, output_size, apix, cutoff_res, backend="auto", precision="double", chunk=1, nthreads=0):
+    # the setup shared by all fft_rescale calls of the same image geometry: the finufft plan (with n_trans=chunk),
+    # its non-uniform points and input workspace of chunk images, or the chirp-z/fft plans of both axes
+    ny, nx = image_shape
+    ony, onx = output_size
+    cutoff_res_y, cutoff_res_x = cutoff_res
+    if backend == "auto":
+        backend = choose_fft_rescale_backend((ny, nx), output_size, apix, cutoff_res)
+    dtype = np.complex64 if precision == "single" else np.complex128
+    real_dtype = np.float32 if precision == "single" else np.float64
+
+    plan = {"backend": backend, "dtype": dtype}
+    if backend == "nufft":
+        plan["input"] = np.zeros((chunk, ny, nx), dtype=dtype)
+        freq_y = np.fft.fftfreq(ony) * 2*apix/cutoff_res_y
+        freq_x = np.fft.fftfreq(onx) * 2*apix/cutoff_res_x
+        Y, X = np.meshgrid(freq_y, freq_x, indexing='ij')
+        Y = (2*np.pi * Y).flatten(order='C')
+        X = (2*np.pi * X).flatten(order='C')
+
+        plan["nufft"] = finufft.Plan(2, (ny, nx), n_trans=chunk, eps=1e-6, dtype=np.dtype(dtype).name, nthreads=nthreads)
+        plan["nufft"].setpts(x=Y.astype(real_dtype), y=X.astype(real_dtype))
+
+        phase_shift = np.ones((ony, onx), dtype=real_dtype)
         phase_shift[1::2, :] *= -1
         phase_shift[:, 1::2] *= -1
-        fft *= phase_shift
-        if len(images.shape)==3 and images.shape[0]==1:
-            fft = fft[np.newaxis, :, :]
-    # now fft has the same layout and phase origin (i.e. np.fft.ifft2(fft) would obtain original image)
-    return fft
+        plan["phase_shift"] = phase_shift
+    else:
+        plan["x"] = plan_zoom_dft(nx, onx, 2*apix/cutoff_res_x, backend=backend, dtype=dtype)
+        plan["y"] = plan_zoom_dft(ny, ony, 2*apix/cutoff_res_y, backend=backend, dtype=dtype)
+    return plan
+
+def fft_backend_supported(output_size, apix, cutoff_res):
+    # the fft backend is exact if each output grid is a sub-grid of a regular FFT grid of size m=on/scale
+    for on, res in zip(output_size, cutoff_res):
+        m = on * res / (2*apix)
+        if abs(m - round(m)) > 1e-6 * m: return False
+    return True
+
+def choose_fft_rescale_backend(image_size, output_size, apix, cutoff_res):
+    # the fft backend is chosen if it is exact and that FFT is not much larger than the chirp-z transform of the same axis
+    from scipy.fft import next_fast_len
+    if not fft_backend_supported(output_size, apix, cutoff_res): return "czt"
+    for n, on, res in zip(image_size, output_size, cutoff_res):
+        if round(on * res / (2*apix)) > 2 * next_fast_len(n + on - 1): return "czt"
+    return "fft"
+
+def plan_zoom_dft(n, m, scale, backend="czt", dtype=np.complex128):
+    # DFT of n samples at the m frequencies np.fft.fftfreq(m)*scale (cycles/pixel)
+    # with the same phase origin as finufft (i.e. sample n//2 is at the origin)
+    # and the sign flip of every other output for the real-space shift by half of the box
+    import scipy.fft as scipy_fft
+    k = np.round(np.fft.fftfreq(m) * m).astype(int)  # signed frequency indices in fft order
+    step = scale / m
+    plan = {"backend": backend, "n": n, "m": m}
+    factor = np.exp(2j*np.pi*step*k*(n//2))
+    factor[1::2] *= -1
+    if backend == "fft":
+        plan["mfft"] = int(round(1/step))
+        if abs(plan["mfft"]*step - 1) > 1e-6:
+            raise ValueError(f"the fft backend requires an output grid on a regular FFT grid: step={step} cycles/pixel")
+        plan["index"] = k % plan["mfft"]
+    else:
+        # chirp-z transform (Bluestein): X[k] = w^(k^2/2) * sum_j (x[j] * a^-j * w^(j^2/2)) * w^(-(k-j)^2/2)
+        # with w = exp(-2i*pi*step) and a = exp(2i*pi*step*k.min()), computed as a circular convolution
+        nfft = scipy_fft.next_fast_len(n + m - 1)
+        chirp = lambda t: np.exp(-1j*np.pi*step*(t.astype(np.float64)**2))   # w^(t^2/2)
+        j = np.arange(n)
+        plan["pre"] = (np.exp(-2j*np.pi*step*k.min()*j) * chirp(j)).astype(dtype)
+        h = np.zeros(nfft, dtype=np.complex128)
+        h[:m] = 1/chirp(np.arange(m))
+        h[nfft-n+1:] = 1/chirp(np.arange(-n+1, 0))
+        plan["nfft"] = nfft
+        plan["kernel"] = scipy_fft.fft(h).astype(dtype)
+        factor *= np.fft.ifftshift(chirp(np.arange(m)))
+    plan["factor"] = factor.astype(dtype)
+    return plan
+
+def zoom_dft(data, plan, axis=-1):
+    import scipy.fft as scipy_fft
+    n, m = plan["n"], plan["m"]
+    assert data.shape[axis] == n
+    shape = [1] * data.ndim
+    if plan["backend"] == "fft":
+        mfft = plan["mfft"]
+        if n > mfft:    # fold (alias) the input to the FFT size
+            npad = -n % mfft
+            pad = [(0, 0)] * data.ndim
+            pad[axis] = (0, npad)
+            data = np.pad(data, pad)
+            data = np.moveaxis(data, axis, -1)
+            data = data.reshape(data.shape[:-1] + ((n+npad)//mfft, mfft)).sum(axis=-2)
+            data = np.moveaxis(data, -1, axis)
+        ret = scipy_fft.fft(data, n=mfft, axis=axis)
+        ret = np.take(ret, plan["index"], axis=axis)
+    else:
+        shape[axis] = n
+        ret = scipy_fft.fft(data * plan["pre"].reshape(shape), n=plan["nfft"], axis=axis)
+        shape[axis] = plan["nfft"]
+        ret *= plan["kernel"].reshape(shape)
+        ret = scipy_fft.ifft(ret, axis=axis, overwrite_x=True)
+        ret = np.take(ret, np.arange(m), axis=axis)
+        ret = np.fft.ifftshift(ret, axes=axis)
+    shape[axis] = m
+    ret *= plan["factor"].reshape(shape)
+    return ret
+
+def align_images(images, angle0, mask=None, max_angle=15.0, refine=False, workers=-1):
+    # center each image and rotate it to the vertical direction, in place, for a whole batch at once:
+    # the rotation is estimated from the mirror symmetry of the (shift invariant) amplitude spectra, the shift
+    # from the cross-correlations of the rotated images with their mirror images, applied as a Fourier phase shift
+    # refine: further refine each image with the simplex search of rotation_trans_align starting from these estimates
+    # workers: the threads of the FFTs, -1 for all cores
+    # returns the additional rotations relative to angle0 (degrees) and the shifts (pixels)
+    import scipy.fft as scipy_fft
+    n, ny, nx = images.shape
+    angle0 = np.broadcast_to(np.asarray(angle0, dtype=np.float64), (n,))
+    if refine: images_orig = images.copy()
+    da = estimate_symmetry_axis_rotations(images, angle0=angle0, max_angle=max_angle, workers=workers)
+    angles = angle0 + da
+    rotate_shift_images(images, angles=angles, out=images)
+    shifts = estimate_symmetry_center_shifts(images if mask is None else images*mask, workers=workers)
+    kx = np.fft.rfftfreq(nx)
+    fft = scipy_fft.rfft(images, axis=-1, workers=workers)
+    fft *= np.exp(2j*np.pi*kx[np.newaxis, :]*shifts[:, np.newaxis])[:, np.newaxis, :]
+    images[:] = scipy_fft.irfft(fft, n=nx, axis=-1, workers=workers)
+    dxy = np.abs(shifts)
+    if refine:
+        for i in range(n):
+            # the post-rotation shift (0, -shift) is equivalent to a pre-rotation shift of m*(0, -shift)
+            ang = np.deg2rad(angles[i])
+            pre_dy, pre_dx = -shifts[i]*np.sin(ang), -shifts[i]*np.cos(ang)
+            images[i], dda, dxy[i] = rotation_trans_align(image=images_orig[i], angle0=angles[i], dx0=pre_dx, dy0=pre_dy, mask=mask)
+            da[i] += dda
+    return da, dxy
+
+def estimate_symmetry_axis_rotations(images, angle0, max_angle=15.0, n_theta=720, workers=-1):
+    # rotation (degrees) to add to angle0 that makes the mirror symmetry axis of each image vertical/horizontal,
+    # searched within +/-max_angle. A symmetry axis at angle beta makes the polar amplitude spectrum P(phi) = P(2*beta-phi),
+    # thus the angular self-convolution of P peaks at 2*beta. The spectra are zero-padded 2x and smoothed to avoid the
+    # bias of sampling the narrow equator on the square grid, and only the low resolution part (dominated by the filament) is used
+    import scipy.fft as scipy_fft
+    from scipy.ndimage import gaussian_filter, map_coordinates
+    n, ny, nx = images.shape
+    pny, pnx = 2*ny, 2*nx
+    Y, X = np.meshgrid(np.arange(ny, dtype=np.float32)-ny//2, np.arange(nx, dtype=np.float32)-nx//2, indexing='ij')
+    r = np.hypot(Y/(ny//2), X/(nx//2))
+    circular_mask = np.clip((0.9-r)/0.1, 0, 1)
+    circular_mask = (1-np.cos(np.pi*circular_mask))/2
+
+    amp = np.abs(scipy_fft.fftshift(scipy_fft.fft2(images*circular_mask, s=(pny, pnx), workers=workers), axes=(-2, -1))).astype(np.float32)
+    amp = gaussian_filter(amp, sigma=(0, 1, 1))
+    radius = np.arange(4, min(pny, pnx)//2 * 0.4, 1.0, dtype=np.float32)
+    theta = np.arange(n_theta, dtype=np.float32) * np.pi/n_theta
+    R, T = np.meshgrid(radius, theta, indexing='ij')
+    coords = np.empty((3, n) + R.shape, dtype=np.float32)
+    coords[0] = np.arange(n, dtype=np.float32)[:, np.newaxis, np.newaxis]
+    coords[1] = pny//2 + R*np.sin(T)
+    coords[2] = pnx//2 + R*np.cos(T)
+    polar = map_coordinates(amp, coords, order=1)   # (n, n_radius, n_theta)
+    polar = np.log1p(polar)
+    polar -= polar.mean(axis=-1, keepdims=True)
+    polar_fft = scipy_fft.rfft(polar, axis=-1)
+    corr = scipy_fft.irfft(np.sum(polar_fft*polar_fft, axis=1), n=n_theta, axis=-1)    # (n, n_theta): peak at 2*beta (mod 180°)
+
+    # rotating the image by beta (mod 90°) brings its symmetry axis to the vertical/horizontal direction
+    step = 180.0/n_theta
+    k = np.arange(n_theta)
+    ret = np.zeros(n)
+    for i in range(n):
+        da = (k*step/2 - angle0[i] + 45) % 90 - 45   # candidate rotations relative to angle0
+        c = np.where(np.abs(da) <= max_angle, corr[i], -np.inf)
+        j = np.argmax(c)
+        cm, c0, cp = corr[i, (j-1)%n_theta], corr[i, j], corr[i, (j+1)%n_theta]
+        denom = cm - 2*c0 + cp
+        frac = np.clip(0.5*(cm-cp)/denom, -0.5, 0.5) if denom<0 else 0
+        ret[i] = da[j] + frac*step/2
+    return ret
+
+def estimate_symmetry_center_shifts(images, workers=-1):
+    # shift (pixels) of the mirror symmetry axis of each vertical filament relative to the box center nx//2,
+    # from the cross-correlation of the image with its mirror image across the center: an image symmetric around
+    # nx//2+s correlates with its mirror with the peak at 2*s. Shifts along the filament do not change the power spectra
+    # or the phase differences across meridian and are not estimated
+    import scipy.fft as scipy_fft
+    n, ny, nx = images.shape
+    fft = scipy_fft.fft2(images, workers=workers)
+    mirror = fft[:, :, (-np.arange(nx)) % nx]
+    corr = scipy_fft.ifft2(fft * np.conj(mirror), workers=workers).real
+    corr = np.max(corr, axis=1)    # (n, nx)
+    idx = np.arange(n)
+    p = np.argmax(corr, axis=-1)
+    cm, c0, cp = corr[idx, (p-1)%nx], corr[idx, p], corr[idx, (p+1)%nx]
+    denom = cm - 2*c0 + cp
+    frac = np.where(denom<0, np.clip(0.5*(cm-cp)/np.where(denom<0, denom, 1), -0.5, 0.5), 0)
+    d = p + frac + 2*(nx//2)
+    d = (d + nx/2) % nx - nx/2
+    return d/2
 
 def rotation_trans_align(image, angle0, dx0=0, dy0=0, mask=None):
     # further refine rotation/shift
@@ -426,6 +1428,8 @@ def rotation_trans_align(image, angle0, dx0=0, dy0=0, mask=None):
 def rotate_shift_image(data, angle=0, pre_shift=(0, 0), post_shift=(0, 0), rotation_center=None, order=1):
     # pre_shift/rotation_center/post_shift: [y, x]
     if angle==0 and pre_shift==[0,0] and post_shift==[0,0]: return data*1.0
+    if order == 1:
+        return rotate_shift_images(data[np.newaxis], angles=angle, pre_shift=pre_shift, post_shift=post_shift, rotation_center=rotation_center, order=order)[0]
     ny, nx = data.shape
     if rotation_center is None:
         rotation_center = np.array((ny//2, nx//2), dtype=np.float32)
@@ -442,6 +1446,88 @@ def rotate_shift_image(data, angle=0, pre_shift=(0, 0), post_shift=(0, 0), rotat
     ret = affine_transform(data, matrix=m, offset=offset, order=order, mode='constant')
     return ret
 
+def rotate_shift_images(images, angles, pre_shift=None, post_shift=None, rotation_center=None, taper=None, order=1, out=None):
+    # rotate/shift each image of a stack (n, ny, nx) by its own angle (degrees) and shifts ([y, x] pixels, one pair or one per image)
+    # with the same conventions as rotate_shift_image, multiply the rotated images with the tapering filter if provided,
+    # and write the results into out (can be images itself for in-place operation)
+    # order: 1 - bilinear (same as scipy affine_transform), 3 - cubic convolution (Keys, a=-0.5)
+    assert order in [1, 3], f"order={order} is not supported. use 1 (bilinear) or 3 (cubic convolution)"
+    n, ny, nx = images.shape
+    angles = np.broadcast_to(np.asarray(angles, dtype=np.float64), (n,))
+    pre_shift = np.broadcast_to(np.asarray((0, 0) if pre_shift is None else pre_shift, dtype=np.float64), (n, 2))
+    post_shift = np.broadcast_to(np.asarray((0, 0) if post_shift is None else post_shift, dtype=np.float64), (n, 2))
+    if rotation_center is None:
+        rotation_center = (ny//2, nx//2)
+    rotation_center = np.asarray(rotation_center, dtype=np.float64)
+    ang = np.deg2rad(angles)
+    m = np.empty((n, 2, 2))
+    m[:, 0, 0], m[:, 0, 1] = np.cos(ang), np.sin(ang)
+    m[:, 1, 0], m[:, 1, 1] = -np.sin(ang), np.cos(ang)
+    offsets = -np.einsum('nij,nj->ni', m, post_shift)   # post_rotation shift
+    offsets += rotation_center - np.einsum('nij,j->ni', m, rotation_center)    # rotation around the specified center
+    offsets -= pre_shift    # pre-rotation shift
+    if taper is None:
+        taper = np.ones((ny, nx), dtype=np.float32)
+    if out is None:
+        out = np.empty_like(images)
+    inplace = np.shares_memory(images, out)
+    _rotate_shift_images(images, m, offsets, taper, order, inplace, out)
+    return out
+
+@numba.jit(nopython=True, cache=True, nogil=True, parallel=True)
+def _rotate_shift_images(images, matrices, offsets, taper, order, inplace, out):
+    n, ny, nx = images.shape
+    for i in range(n):
+        src = images[i].copy() if inplace else images[i]
+        m00, m01, m10, m11 = matrices[i, 0, 0], matrices[i, 0, 1], matrices[i, 1, 0], matrices[i, 1, 1]
+        dy, dx = offsets[i, 0], offsets[i, 1]
+        identity = m00==1 and m01==0 and m10==0 and m11==1 and dy==0 and dx==0
+        for oy in numba.prange(ny):
+            for ox in range(nx):
+                if identity:
+                    v = src[oy, ox]
+                else:
+                    y = m00*oy + m01*ox + dy
+                    x = m10*oy + m11*ox + dx
+                    if order == 1:
+                        v = _interpolate_linear(src, y, x)
+                    else:
+                        v = _interpolate_cubic(src, y, x)
+                out[i, oy, ox] = v * taper[oy, ox]
+
+@numba.jit(nopython=True, cache=True, nogil=True)
+def _interpolate_linear(data, y, x):
+    # zero outside of the image, as scipy.ndimage mode='constant'
+    ny, nx = data.shape
+    if y < 0 or y > ny-1 or x < 0 or x > nx-1: return 0.0
+    y0, x0 = int(y), int(x)
+    y1, x1 = min(y0+1, ny-1), min(x0+1, nx-1)
+    fy, fx = y-y0, x-x0
+    return (1-fy)*((1-fx)*data[y0, x0] + fx*data[y0, x1]) + fy*((1-fx)*data[y1, x0] + fx*data[y1, x1])
+
+@numba.jit(nopython=True, cache=True, nogil=True)
+def _cubic_convolution_weight(t):
+    a = -0.5
+    t = abs(t)
+    if t <= 1: return ((a+2)*t - (a+3))*t*t + 1
+    if t < 2: return ((a*t - 5*a)*t + 8*a)*t - 4*a
+    return 0.0
+
+@numba.jit(nopython=True, cache=True, nogil=True)
+def _interpolate_cubic(data, y, x):
+    # zero outside of the image, edge pixels are replicated for the 4x4 neighborhood
+    ny, nx = data.shape
+    if y < 0 or y > ny-1 or x < 0 or x > nx-1: return 0.0
+    y0, x0 = int(y), int(x)
+    v = 0.0
+    for j in range(-1, 3):
+        wy = _cubic_convolution_weight(y-(y0+j))
+        yi = min(max(y0+j, 0), ny-1)
+        for k in range(-1, 3):
+            xi = min(max(x0+k, 0), nx-1)
+            v += wy * _cubic_convolution_weight(x-(x0+k)) * data[yi, xi]
+    return v
+
 def generate_tapering_filter(image_size, fraction_start=[0, 0], fraction_slope=0.1):
     ny, nx = image_size
     fy, fx = fraction_start
@@ -468,47 +1554,46 @@ def generate_tapering_filter(image_size, fraction_start=[0, 0], fraction_slope=0
         filter *= X
     return filter
 
-def star2dataframe(starFile):
+def star2dataframe(starFile, columns="rlnImageName rlnOpticsGroup rlnPixelSize rlnClassNumber rlnHelicalTubeID rlnAnglePsiPrior".split(), coordinates=False):
+    # only the columns needed by image2dataframe are read by default. columns=None reads all columns
+    # coordinates: also read the micrographs and the particle coordinates in them (micrograph, x, y, micrograph_apix)
     import pandas as pd
-    import_with_auto_install("gemmi")
-    from gemmi import cif
-    star = cif.read_file(starFile)
-    if len(star) == 2:
-        optics = cif.Document()
-        optics.add_copied_block(star[0])
-        del star[0]
-        js = optics.as_json(True)  # True -> preserve case
-        optics = pd.read_json(js).T
-        d = {c.strip('_'): optics[c].values[0] for c in optics}
-        optics = pd.DataFrame(d)
-    else:
-        optics = None
-    js = star.as_json(True)  # True -> preserve case
-    data = pd.read_json(js).T
-    d = {c.strip('_'): data[c].values[0] for c in data}
-    data = pd.DataFrame(d)
-    
-    assert("rlnImageName" in data)
-    tmp = data["rlnImageName"].str.split("@", expand=True)
-    indices, filenames = tmp.iloc[:,0], tmp.iloc[:, -1]
-    indices = indices.astype(int)-1
-    data["pid"] = indices
-    data["filename"] = filenames
-
-    if optics is not None:
+    name_column = "rlnMicrographName" if coordinates else "rlnImageName"
+    if coordinates and columns is not None:
+        columns = list(columns) + "rlnMicrographName rlnCoordinateX rlnCoordinateY rlnMicrographPixelSize".split()
+    tables = read_star_tables(starFile, columns=columns)
+    blocks = [b for b in tables if name_column in tables[b] and b != "optics"]
+    if not blocks:
+        print(f"ERROR: {starFile} does not have {name_column}")
+        sys.exit(-1)
+    data = tables["particles" if "particles" in blocks else blocks[-1]]
+    optics = tables.get("optics", None)
+
+    if "rlnImageName" in data:
+        tmp = [name.partition("@") for name in data["rlnImageName"].values]   # much faster than Series.str.split
+        data["pid"] = np.fromiter((int(t[0]) for t in tmp), dtype=int, count=len(tmp)) - 1
+        data["filename"] = [t[2] for t in tmp]
+    if coordinates:
+        data["micrograph"] = data["rlnMicrographName"]
+        data["x"] = data["rlnCoordinateX"].astype(float)
+        data["y"] = data["rlnCoordinateY"].astype(float)
+
+    if optics is not None and "rlnOpticsGroup" in data and "rlnOpticsGroup" in optics:
         og_names = set(optics["rlnOpticsGroup"].unique())
-        for gn, g in data.groupby("rlnOpticsGroup", sort=False):
-            if gn not in og_names:
-                print(f"ERROR: optic group {gn} not available ({sorted(og_names)})")
-                sys.exit(-1)
-            ptcl_indices = g.index
-            og_index = optics["rlnOpticsGroup"] == gn
-            if "rlnPixelSize" in optics:
-                data.loc[ptcl_indices, "apix"] = optics.loc[og_index, "rlnPixelSize"].astype(float).iloc[0]
+        missing = sorted(set(data["rlnOpticsGroup"].unique()) - og_names)
+        if missing:
+            print(f"ERROR: optic group {missing[0]} not available ({sorted(og_names)})")
+            sys.exit(-1)
+        if "rlnPixelSize" in optics:
+            og_apix = optics.drop_duplicates("rlnOpticsGroup").set_index("rlnOpticsGroup")["rlnPixelSize"].astype(float)
+            data["apix"] = data["rlnOpticsGroup"].map(og_apix)
+        if "rlnMicrographPixelSize" in optics:
+            og_apix = optics.drop_duplicates("rlnOpticsGroup").set_index("rlnOpticsGroup")["rlnMicrographPixelSize"].astype(float)
+            data["micrograph_apix"] = data["rlnOpticsGroup"].map(og_apix)
     if "rlnPixelSize" in data:
-        data.loc[:, "apix"] = data["rlnPixelSize"]
+        data.loc[:, "apix"] = data["rlnPixelSize"].astype(float)
     if "rlnClassNumber" in data:
-        data.loc[:, "class"] = data["rlnClassNumber"]
+        data.loc[:, "class"] = pd.to_numeric(data["rlnClassNumber"])
     if "rlnHelicalTubeID" in data:
         data.loc[:, "helicaltube"] = data["rlnHelicalTubeID"].astype(int)-1
     if "rlnAnglePsiPrior" in data:
@@ -516,21 +1601,89 @@ def star2dataframe(starFile):
 
     return data
 
-def cs2dataframe(csFile):
+def read_star_tables(starFile, columns=None):
+    # returns {block name: DataFrame of str columns}
+    # the file is scanned once for the data blocks, loop labels and row ranges,
+    # then the rows of each loop are parsed by the pandas C parser, only keeping the requested columns
+    import pandas as pd
+    loops = []  # [block, labels, first row line, number of rows]
+    pairs = {}  # {block: {label: value}} of the non-loop items
+    block, loop = None, None
+    with open(starFile) as fp:
+        for lineno, line in enumerate(fp):
+            if loop is not None and loop[2] is not None and line[0] not in "_#ld \t\r\n":   # most lines are loop rows
+                loop[3] += 1
+                continue
+            s = line.strip()
+            if not s or s[0] == "#": continue
+            c = s[0]
+            if s.startswith("data_"):
+                block, loop = s[5:], None
+                pairs[block] = {}
+            elif s.startswith("loop_"):
+                loop = [block, [], None, 0]
+                loops.append(loop)
+            elif c == "_" and loop is not None and loop[2] is None:
+                loop[1].append(s.split()[0][1:])
+            elif c == "_":
+                items = s.split(None, 1)
+                pairs[block][items[0][1:]] = items[1].strip("'\"") if len(items)>1 else ""
+                loop = None
+            elif loop is not None:
+                if loop[2] is None: loop[2] = lineno
+                loop[3] += 1
+            else:
+                print(f"WARNING: {starFile} line {lineno+1} is ignored: {s[:80]}")
+
+    tables = {}
+    for block in pairs:
+        if pairs[block]:
+            tables[block] = pd.DataFrame({k: [v] for k, v in pairs[block].items() if columns is None or k in columns})
+    for block, labels, first, nrows in loops:
+        usecols = [i for i, label in enumerate(labels) if columns is None or label in columns]
+        if first is None or not usecols:
+            tables[block] = pd.DataFrame({labels[i]: pd.Series(dtype=str) for i in usecols})
+            continue
+        table = pd.read_csv(starFile, sep=r"\s+", header=None, skiprows=first, nrows=nrows, usecols=usecols, dtype=str, comment="#", quotechar="'", engine="c")
+        table.columns = [labels[i] for i in table.columns]
+        tables[block] = table
+    return tables
+
+def cs2dataframe(csFile, fields="blob/idx blob/path blob/psize_A filament/filament_uid filament/filament_pose alignments2D/class".split(), coordinates=False):
     # read CryoSPARC v2/3 meta data
-    cs = np.load(csFile)
+    # only the requested fields are copied out of the memory-mapped structured arrays. fields=None reads all fields
+    # coordinates: also read the micrographs and the particle coordinates in them (micrograph, x, y, micrograph_apix)
     import pandas as pd
-    data = pd.DataFrame.from_records(cs.tolist(), columns=cs.dtype.names)
+    if coordinates and fields is not None:
+        fields = list(fields) + "location/micrograph_path location/center_x_frac location/center_y_frac location/micrograph_shape location/micrograph_psize_A".split()
+    cs = np.load(csFile, mmap_mode="r")
+    selected = lambda cs: [f for f in cs.dtype.names if fields is None or f in fields]
+    data = pd.DataFrame({f: decode_cs_field(cs[f]) for f in selected(cs)})
     if csFile.find("passthrough_particles") == -1:
         ptfs = sorted(pathlib.Path(csFile).parent.glob("*passthrough_particles*.cs"))
-        if ptfs:
-            extra_data = []
-            for ptf in ptfs:
-                passthrough_file = ptf.as_posix()
-                cs = np.load(passthrough_file)
-                if len(cs) != len(data): continue                    
-                extra_data += [ pd.DataFrame.from_records(cs.tolist(), columns=cs.dtype.names) ]
-            data = pd.concat([data] + extra_data, axis=1)
+        for ptf in ptfs:
+            passthrough_file = ptf.as_posix()
+            pt = np.load(passthrough_file, mmap_mode="r")
+            pt_fields = [f for f in selected(pt) if f not in data]
+            if not pt_fields: continue
+            if "uid" in cs.dtype.names and "uid" in pt.dtype.names:   # join by particle uid
+                uid, pt_uid = np.asarray(cs["uid"]), np.asarray(pt["uid"])
+                if len(uid) == len(pt_uid) and np.array_equal(uid, pt_uid):
+                    rows = slice(None)
+                else:
+                    # merged or re-imported jobs can list a particle more than once: the first row of each uid is used
+                    first = np.flatnonzero(~pd.Index(pt_uid).duplicated())
+                    if len(first) < len(pt_uid):
+                        print(f"WARNING: {passthrough_file} has {len(pt_uid)-len(first)} duplicated particle uids. the first row of each uid is used")
+                    rows = pd.Index(pt_uid[first]).get_indexer(uid)
+                    if (rows<0).any(): continue
+                    rows = first[rows]
+            elif len(pt) == len(cs):
+                rows = slice(None)
+            else:
+                continue
+            for f in pt_fields:
+                data[f] = decode_cs_field(pt[f])[rows]
     mapping = {"blob/idx":"pid", "blob/psize_A":"apix", "filament/filament_uid":"helicaltube"}
     for key in mapping:
         if key in data:
@@ -540,27 +1693,83 @@ def cs2dataframe(csFile):
     if "alignments2D/class" in data:
         data.loc[:, "class"] = data["alignments2D/class"]
     if "blob/path" in data:
-        data.loc[:, "filename"] = data["blob/path"].str.decode("utf-8")
+        data.loc[:, "filename"] = data["blob/path"]
+    if coordinates and "location/micrograph_path" in data:
+        data.loc[:, "micrograph"] = data["location/micrograph_path"]
+        shape = np.array(list(data["location/micrograph_shape"]))   # (ny, nx) of each micrograph
+        data.loc[:, "x"] = data["location/center_x_frac"] * shape[:, 1]
+        data.loc[:, "y"] = data["location/center_y_frac"] * shape[:, 0]
+        if "location/micrograph_psize_A" in data:
+            data.loc[:, "micrograph_apix"] = data["location/micrograph_psize_A"]
     return data
 
+def decode_cs_field(values):
+    # byte strings (e.g. blob/path) are decoded once per unique value
+    # float32 values are promoted to float64 as cs.tolist() did
+    values = np.asarray(values)
+    if values.dtype.kind == "f":
+        values = values.astype(np.float64)
+    if values.dtype.kind == "S":
+        uniques, inverse = np.unique(values, return_inverse=True)
+        return np.array([u.decode("utf-8") for u in uniques], dtype=object)[inverse]
+    if values.ndim > 1:
+        return list(values)
+    return values
+
 def lst2dataframe(lstFile):
-    data = []
-    vars = []
-    with open(lstFile) as fp:
-        for l in fp:
-            if l[0] == "#": continue
-            items = l.split()
-            if len(items) < 2: continue
-            d = [ ("pid", int(items[0]) ), ("filename", items[1]) ]
-            d+= [ it.split("=") for it in items[2:] ]
-            if len(d)>len(vars):    # to preserve order
-                vars = [v[0] for v in d]
-            data.append(dict(d))
+    # jspr lst format: pid<tab>filename<tab>key=value<tab>..., after the # header lines, padded to a fixed line width
+    import io, csv
     import pandas as pd
-    p = pd.DataFrame(data).loc[:, vars]
-    if "phi0" not in p and "euler" in p:
-        p.loc[:, "phi0"] = p["euler"].str.split(",", expand=True).iloc[:, -1].astype(float)
-    return p
+    with open(lstFile, "rb") as fp:
+        text = fp.read()
+    header_size = 0
+    while text.startswith(b"#", header_size):
+        header_size = text.find(b"\n", header_size) + 1 or len(text)
+    body = text[header_size:]
+    if body and not body.endswith(b"\n"): body += b"\n"
+    # count the fields and = signs of each line without splitting the lines
+    buf = np.frombuffer(body, dtype=np.uint8)
+    newlines = np.flatnonzero(buf == ord("\n"))
+    ntabs = np.bincount(np.searchsorted(newlines, np.flatnonzero(buf == ord("\t"))), minlength=len(newlines))
+    nequals = np.bincount(np.searchsorted(newlines, np.flatnonzero(buf == ord("="))), minlength=len(newlines))
+    ntokens = max(0, ntabs.max(initial=1) - 1)
+    if ntokens and (nequals == np.maximum(ntabs-1, 0)).all():
+        # the = signs only separate the keys and values: the C parser splits and converts all columns at once
+        names = list(range(2 + 2*ntokens))
+        p = pd.read_csv(io.BytesIO(body.replace(b"=", b"\t")), sep="\t", header=None, names=names, dtype={n: str for n in [1] + names[2::2]}, quoting=csv.QUOTE_NONE, engine="c")
+        key_columns = [(p[j], p[j+1]) for j in names[2::2]]
+    else:
+        names = list(range(2 + ntokens))
+        p = pd.read_csv(io.BytesIO(body), sep="\t", header=None, names=names, dtype=str, quoting=csv.QUOTE_NONE, keep_default_na=False, na_values=[""], engine="c")
+        key_columns = []
+        for j in names[2:]:
+            tokens = [t.rstrip().partition("=") if isinstance(t, str) else (np.nan, "", np.nan) for t in p[j].values]
+            key_columns.append((pd.Series([t[0] for t in tokens]), pd.Series([t[2] for t in tokens])))
+    p = p[p[1].notna()]
+    # the padding spaces are only kept by the str columns. numeric columns are parsed regardless
+    data = pd.DataFrame({"pid": p[0].astype(int).values, "filename": p[1].str.rstrip().values})
+    # usually all tokens at a field position have the same key
+    for keys, values in key_columns:
+        keys, values = keys[p.index], values[p.index]
+        for key in keys.dropna().unique():
+            column = values.where(keys == key)
+            column = (column.str.rstrip() if column.dtype == object else column).values
+            data[key] = column if key not in data else data[key].where(data[key].notna(), column)
+    for key in list(data)[2:]:
+        if data[key].dtype == object:
+            try:
+                data[key] = pd.to_numeric(data[key])
+            except (ValueError, TypeError):
+                pass
+        # a key missing from some lines turns an integer column into float (NaN): keep it integer so that the group
+        # names read class=1, not class=1.0
+        if data[key].dtype.kind == "f" and data[key].isna().any():
+            values = data[key].dropna().values
+            if len(values) and (values == np.round(values)).all():
+                data[key] = data[key].astype("Int64")
+    if "phi0" not in data and "euler" in data:
+        data.loc[:, "phi0"] = [float(e.rpartition(",")[2]) if isinstance(e, str) else np.nan for e in data["euler"].values]
+    return data
 
 def mrc2dataframe(mrcFile):
     import mrcfile
@@ -571,14 +1780,20 @@ def mrc2dataframe(mrcFile):
     p = pd.DataFrame({"pid":range(nz), "filename":mrcFile, 'apix':apix})
     return p
 
-def image2dataframe(inputFile):
+def image2dataframe(inputFile, verbose=0, extract=False):
+    # extract: the particles are cut from the micrographs at their coordinates instead of read from particle stacks.
+    # filename is then the micrograph and pid the order of the particle in its micrograph, which is not stable across
+    # meta data files: these particles are identified by their coordinates instead (see particle_keys)
     if not pathlib.Path(inputFile).exists():
         print(f"ERROR: cannot find file {inputFile}")
         sys.exit(-1)
+    if extract and not (inputFile.endswith(".star") or inputFile.endswith(".cs")):
+        print(f"ERROR: the particle coordinates can only be read from star or cs files, not {inputFile}")
+        sys.exit(-1)
     if inputFile.endswith(".star"):    # relion
-        p = star2dataframe(inputFile)
+        p = star2dataframe(inputFile, coordinates=extract)
     elif inputFile.endswith(".cs"):  # cryosparc
-        p = cs2dataframe(inputFile)
+        p = cs2dataframe(inputFile, coordinates=extract)
     elif inputFile.endswith(".lst"):    # jspr
         p = lst2dataframe(inputFile)
     elif inputFile.endswith(".mrc") or inputFile.endswith(".mrcs"):
@@ -587,39 +1802,78 @@ def image2dataframe(inputFile):
         print("ERROR: {inputFile} is in a unsupported format")
         sys.exit(-1)
     
-    cols = [c for c in "pid filename apix class helicaltube phi0".split() if c in p]
+    if extract:
+        missing = [c for c in "micrograph x y".split() if c not in p]
+        if missing:
+            print(f"ERROR: {inputFile} does not have the micrographs and particle coordinates")
+            sys.exit(-1)
+        p["filename"] = p["micrograph"]
+        p["pid"] = p.groupby("micrograph", sort=False).cumcount().values
+        # the pixel size of the micrographs, from their headers if not in the meta data
+        p = p.drop(columns=["apix"], errors="ignore")
+        if "micrograph_apix" in p: p["apix"] = p["micrograph_apix"]
+
+    cols = [c for c in "pid filename apix class helicaltube phi0 x y".split() if c in p]
     p = p.loc[:, cols]
 
     int_types = "pid helicaltube".split()
-    float_types = "apix phi0".split()
+    float_types = "apix phi0 x y".split()
     for i in int_types:
         if i in p: p.loc[:, i] = p.loc[:, i].astype(int)
     for f in float_types:
         if f in p: p.loc[:, f] = p.loc[:, f].astype(float)
     
     dir0 = pathlib.Path(inputFile).parent
-    mapping = {}
-    for f in p["filename"].unique():
-        if f in mapping: continue
-        fp = pathlib.Path(f)
-        name = fp.name
-        choices = [fp, dir0/fp, dir0/".."/fp, dir0/"../.."/fp, dir0/name, dir0/".."/name, dir0/"../.."/name]
-        for choice in choices:
-            if choice.exists():
-                mapping[f] = choice.resolve().as_posix()
-                break
-        if f in mapping:
-            fp2 = pathlib.Path(mapping[f])
-            for fo in fp2.parent.glob("*"+fp.suffix):
-                ftmp = (fp.parent / fo.name).as_posix()
-                mapping[ftmp] = fo.as_posix()
-    for f in p["filename"].unique():
-        if f not in mapping:
+    import time
+    t0 = time.time()
+    mapping, stats = resolve_filenames(p["filename"].unique(), dir0)
+    if verbose>0:
+        print(f"Resolved {len(mapping)} filenames in {time.time()-t0:.2f} s: {stats['listings']} directory listings and {stats['lookups']} lookups")
+    for f in mapping:
+        if mapping[f] is None:
             print(f"WARNING: {f} is not accessible")
             mapping[f] = f
     p.loc[:, "filename"] = p.loc[:, "filename"].map(mapping)
     return p
 
+def resolve_filenames(filenames, dir0):
+    # look for each file at its recorded path and then relative to the folder of the input file (and its parents)
+    # each candidate folder is listed only once, and all filenames are looked up in these in-memory listings
+    import os
+    listings = {}
+    def listing(folder):
+        if folder not in listings:
+            try:
+                with os.scandir(folder or ".") as it:
+                    listings[folder] = set(e.name for e in it)
+            except OSError:
+                listings[folder] = set()
+        return listings[folder]
+    resolved_folders = {}
+    def resolve_folder(folder):
+        if folder not in resolved_folders:
+            resolved_folders[folder] = pathlib.Path(folder or ".").resolve()
+        return resolved_folders[folder]
+
+    by_folder = {}
+    for f in filenames:
+        fp = pathlib.Path(f)
+        by_folder.setdefault(fp.parent.as_posix() if fp.parent != pathlib.Path(".") else "", []).append((f, fp.name))
+    mapping = {}
+    lookups = 0
+    for folder, files in by_folder.items():
+        fp = pathlib.Path(folder)
+        candidates = [fp, dir0/fp, dir0/".."/fp, dir0/"../.."/fp, dir0, dir0/"..", dir0/"../.."]
+        candidates = list(dict.fromkeys(c.as_posix() if c != pathlib.Path(".") else "" for c in candidates))
+        for f, name in files:
+            mapping[f] = None
+            for candidate in candidates:
+                lookups += 1
+                if name in listing(candidate):
+                    mapping[f] = (resolve_folder(candidate) / name).as_posix()
+                    break
+    return mapping, dict(listings=len(listings), lookups=lookups)
+
 def dataframe2lst(data, lstFile):
     int_types = "pid nptcls".split()
     float_types = "apix".split()
@@ -632,23 +1886,36 @@ def dataframe2lst(data, lstFile):
     keys.remove("pid")
     keys.remove("filename")
 
-    lines = data['pid'].astype(str) + '\t' + data['filename']
+    # format each column as a whole, then join the fields of each line once
+    fields = [data['pid'].astype(str).values, '\t' + np.asarray(data['filename'].values, dtype=object)]
     for k in keys:
-        mask = data[k].notnull()
+        mask = data[k].notnull().values
         if data[k].dtype in [np.float64, np.float32]:
-            lines[mask] += '\t' + k + '=' + data[k][mask].round(6).astype(str)
+            values = data[k].round(6).astype(str).values
         else:
-            lines[mask] += '\t' + k + '=' + data[k][mask].astype(str)
-    lines = lines.str.strip()
+            values = data[k].astype(str).values
+        field = np.full(len(data), "", dtype=object)
+        field[mask] = ('\t' + k + '=') + values[mask].astype(object)
+        fields.append(field)
+    lines = ["".join(items).strip() for items in zip(*fields)]
 
-    maxlen = max(lines.str.len())
-    lines = lines.str.pad(maxlen, side='right')
+    maxlen = max(len(line) for line in lines)
 
     with open(lstFile, "w") as lstfp:
         lstfp.write("#LSX\n#If you edit this file, you MUST rerun lstfast.py on it before using it!\n# %d\n" % (maxlen+1))
-        lstfp.write('\n'.join(lines))
+        lstfp.write('\n'.join(line.ljust(maxlen) for line in lines))
         lstfp.write('\n')
 
+def import_this_module():
+    if __name__ != "__main__": return sys.modules[__name__]
+    code_dir = pathlib.Path(__file__).parent.resolve().as_posix()
+    if code_dir not in sys.path: sys.path.insert(0, code_dir)
+    import importlib
+    try:
+        return importlib.import_module(pathlib.Path(__file__).stem)
+    except ImportError:
+        return sys.modules[__name__]
+
 def run_hill_webapp(query_string):
     import_with_auto_install("streamlit")
     import subprocess
@@ -682,16 +1949,28 @@ def parse_command_line():
     parser.add_argument('--outputPrefix', metavar="<str>", type=str, help="prefix of output files", default="")
     parser.add_argument("--groupby", metavar="<attr>", type=str, nargs="+", help="group particles by these parameters (None, class, helicaltube, etc)", default=[])
     parser.add_argument("--minParticles", metavar="<n>", type=int, help="ignore groups of fewer particles than this minimal count. default: %(default)s", default=-1)
-    parser.add_argument("--batchSize", metavar="<n>", type=int, help="maximal number of particles per batch. default: %(default)s", default=100)
+    parser.add_argument("--batchSize", metavar="<n>", type=int, help="maximal number of particles per batch. <=0: choose it from the available memory, reducing --cpu if needed. default: %(default)s", default=100)
+    parser.add_argument("--extractBox", metavar="<n>", type=int, help="cut boxes of this size (pixels) at the particle coordinates (rlnMicrographName/rlnCoordinateX/Y or cryoSPARC location/*) directly from the micrographs instead of reading the extracted particle stacks. disabled by default", default=0)
     parser.add_argument("--apix", metavar="<Å/pixel>", type=float, help="pixel size of input image", default=0)
     parser.add_argument("--diameterMask", metavar="<Å>", type=float, help="masking with this filament/tube diameter (in Angstrom). disabled by default", default=0)
     parser.add_argument("--cutoffRes", metavar="<float>", type=float, help="compute power spectra up to this resolution. default to 2*apix", default=0)
     parser.add_argument("--fftX", metavar="<nx>", type=int, help="set FFT x-dimenstion to this size. default: %(default)s", default=512)
     parser.add_argument("--fftY", metavar="<ny>", type=int, help="set FFT y-dimenstion to this size. default: %(default)s", default=1024)
-    parser.add_argument("--align", metavar="<0|1>", type=int, help="center each particle and rotate it to the vertical direction. default: %(default)s", default=0)
+    parser.add_argument("--fftBackend", metavar="<auto|nufft|czt|fft>", type=str, choices="auto nufft czt fft".split(), help="method to compute the rescaled Fourier transforms. default: %(default)s", default="auto")
+    parser.add_argument("--precision", metavar="<single|double>", type=str, choices="single double".split(), help="floating point precision of the Fourier transforms. single precision halves the memory per batch. default: %(default)s", default="double")
+    parser.add_argument("--align", metavar="<0|1|2>", type=int, help="center each particle and rotate it to the vertical direction. 1: fast batch alignment, 2: also refine each particle with simplex search. default: %(default)s", default=0)
     parser.add_argument("--forcePhaseDiff", metavar="<0|1>", type=int, help="compute phase differences across meridian even if in-plane angles are not avilable. default: %(default)s", default=0)
+    parser.add_argument("--outputFormat", metavar="<mrcs|npz>", type=str, choices="mrcs npz".split(), help="save the group averages in MRC stacks or in folders of one .npz file per group (<pid>.npz), which are written as soon as each group is complete and can be read one group at a time. default: %(default)s", default="mrcs")
+    parser.add_argument("--outputDtype", metavar="<float32|float16>", type=str, choices="float32 float16".split(), help="data type of the group averages in the .npz files. float16 halves the size of the outputs. default: %(default)s", default="float32")
+    parser.add_argument("--outputCompress", metavar="<0|1>", type=int, help="losslessly compress (deflate) the .npz file of each group. about half the size at float16, but much slower to write. default: %(default)s", default=0)
     parser.add_argument("--showPlot", metavar="<0|1>", type=int, help="display power spectra for indexing. default: %(default)s", default=1)
+    parser.add_argument("--incremental", metavar="<0|1>", type=int, help="only process the particles not seen by previous runs and add them to the sums saved with the existing outputs. default: %(default)s", default=0)
+    parser.add_argument("--checkpointDir", metavar="<dir>", type=str, help="save the partial sums of each batch in this folder and skip the completed batches when the same command is rerun. disabled by default", default="")
+    parser.add_argument("--scratchDir", metavar="<dir>", type=str, help="folder of the temporary group sums shared by the worker processes of --backend processes (ngroups*fftY*fftX*8 bytes with phase differences). default: the system temporary folder", default="")
+    parser.add_argument("--profile", metavar="<0|1>", type=int, help="save the wall time, bytes and throughput of each processing stage to <outputPrefix>.profile.json/.csv. default: %(default)s", default=0)
+    parser.add_argument("--fourierCache", metavar="<dir>", type=str, help="keep the power spectra (float32) and phase difference cosines (float16) of each particle in this folder so that reruns with a different --groupby or --minParticles only sum the cached particles. needs fftY*(fftX/2+1)*6 bytes per particle. disabled by default", default="")
     parser.add_argument("--cpu", metavar="<n>", type=int, help="use this number of cpus/cores. default: %(default)s", default=1)
+    parser.add_argument("--backend", metavar="<threads|processes>", type=str, choices=["threads", "processes"], help="run the batches of --cpu>1 in threads of one process, which share the inputs and the accumulators, or in separate processes. default: %(default)s", default="processes")
     parser.add_argument("--verbose", metavar="<n>", type=int, help="verbose level. default: %(default)s", default=1)
     
     args = parser.parse_args()
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+
+"""
+MIT License
+
+Copyright (c) 2021 Wen Jiang
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+# throughput benchmark of hill_power_spectra.py on synthetic helical segments:
+# simulates the segment stacks and the matching star/cs/lst files once per box size, runs hill_power_spectra.py
+# for each combination of the settings and appends particles/s, peak memory and the time of each stage
+# (from --profile) of every run as one json line to the results file so that different commits can be compared.
+# --starRows also times the columnar star reader against the gemmi/JSON reader of the original version on a large
+# synthetic star file and checks that both give the same particles
+
+import sys, pathlib
+
+code_dir = pathlib.Path(__file__).parent.resolve()
+if code_dir.as_posix() not in sys.path: sys.path.insert(0, code_dir.as_posix())
+import hill_power_spectra as hps
+from hill_power_spectra import np, mrcfile
+
+def main():
+    args = parse_command_line()
+
+    import itertools, json, os, platform, time
+    outputDir = pathlib.Path(args.outputDir)
+    outputDir.mkdir(parents=True, exist_ok=True)
+
+    datasets = {}
+    for box_size in args.boxSizes:
+        t0 = time.time()
+        datasets[box_size] = simulate_dataset(outputDir / f"box{box_size}", box_size=box_size, apix=args.apix, nmicrographs=args.micrographs, nparticles=args.particlesPerMicrograph, segments_per_tube=args.segmentsPerTube, nclasses=args.classes, twist=args.twist, rise=args.rise, csym=args.csym, helical_radius=args.helicalRadius, noise=args.noise, seed=args.seed)
+        if args.verbose:
+            print(f"Simulated {args.micrographs}x{args.particlesPerMicrograph} segments of box={box_size} in {time.time()-t0:.1f} s: {' '.join(str(f) for f in datasets[box_size].values())}")
+
+    # untimed runs that compile/load the numba cache and read the data into the file cache before the timed runs
+    for box_size in args.boxSizes:
+        for wi in range(args.warmup):
+            settings = dict(box=box_size, format=args.formats[0], groupby=args.groupbys[0], align=args.aligns[0], batchSize=args.batchSizes[0], cpu=args.cpus[0], backend=args.backends[0], fftX=args.fftX, fftY=args.fftY, precision=args.precision, repeat=wi)
+            result = run_hill_power_spectra(datasets[box_size][args.formats[0]], outputDir / "runs" / f"warmup_box{box_size}_{wi}", settings)
+            if args.verbose:
+                print(f"Warm-up {wi+1}/{args.warmup}: box={box_size} {result['wall_seconds']:.1f} s wall{'' if result['returncode']==0 else ' FAILED'}")
+
+    commit = git_commit()
+    if args.starRows>0:
+        result = benchmark_star_reader(outputDir / "star", args.starRows, seed=args.seed, verbose=args.verbose)
+        with open(args.results, "a") as fp:
+            fp.write(json.dumps(dict(commit=commit, date=time.strftime("%Y-%m-%dT%H:%M:%S"), host=platform.node(), ncpus=os.cpu_count(), benchmark="star_reader", **result)) + "\n")
+
+    runs = list(itertools.product(args.boxSizes, args.formats, args.groupbys, args.aligns, args.batchSizes, args.cpus, args.backends, range(args.repeats)))
+    with open(args.results, "a") as fp:
+        for ri, (box_size, fmt, groupby, align, batch_size, cpu, backend, repeat) in enumerate(runs):
+            settings = dict(box=box_size, format=fmt, groupby=groupby, align=align, batchSize=batch_size, cpu=cpu, backend=backend, fftX=args.fftX, fftY=args.fftY, precision=args.precision, repeat=repeat)
+            result = run_hill_power_spectra(datasets[box_size][fmt], outputDir / "runs" / f"run{ri:04d}", settings)
+            record = dict(commit=commit, date=time.strftime("%Y-%m-%dT%H:%M:%S"), host=platform.node(), ncpus=os.cpu_count(), **settings, **result)
+            fp.write(json.dumps(record) + "\n")
+            fp.flush()
+            if args.verbose:
+                print(f"Run {ri+1}/{len(runs)}: box={box_size} {fmt} groupby={groupby} align={align} batchSize={batch_size} cpu={cpu} {backend}: {result['particles_per_s'] or 0:.1f} particles/s, {result['tool_seconds'] or 0:.1f} s in the tool, {result['wall_seconds']:.1f} s wall, peak {result['peak_rss_MB']:.0f} MB{'' if result['returncode']==0 else ' FAILED'}")
+    if args.verbose:
+        print(f"{len(runs)} runs saved to {args.results}")
+
+def simulate_dataset(folder, box_size, apix, nmicrographs, nparticles, segments_per_tube, nclasses, twist, rise, csym, helical_radius, noise=1.0, seed=0, nviews=24):
+    # nmicrographs stacks of nparticles segments, in tubes of segments_per_tube segments sharing one in-plane angle
+    # and class. returns {format: metadata file}
+    import pandas as pd
+    folder = pathlib.Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    # a few azimuthal views are simulated once and reused for all segments
+    simulate_helix = load_hill_function("simulate_helix")
+    views = np.array([simulate_helix(twist, rise, csym, helical_radius, ball_radius=rise/4, ny=box_size, nx=box_size, apix=apix, az0=az0) for az0 in np.linspace(0, 360, nviews, endpoint=False)], dtype=np.float32)
+    particles = []
+    for mi in range(nmicrographs):
+        filename = f"micrograph{mi:04d}.mrcs"
+        tubes = np.arange(nparticles) // segments_per_tube
+        ntubes = tubes[-1]+1
+        phi0 = rng.uniform(-180, 180, ntubes)[tubes]
+        images = views[rng.integers(len(views), size=nparticles)]
+        # hill_power_spectra.py rotates the segments by -phi0 back to the vertical direction
+        hps.rotate_shift_images(images, angles=phi0, out=images)
+        images += rng.normal(scale=noise*images.std(), size=images.shape).astype(np.float32)
+        with mrcfile.new(folder / filename, data=images, overwrite=True) as mrc:
+            mrc.voxel_size = apix
+        particles.append(pd.DataFrame(dict(pid=np.arange(nparticles), filename=filename, apix=apix, helicaltube=mi*nparticles+tubes, phi0=phi0, **{"class": rng.integers(1, nclasses+1, ntubes)[tubes]})))
+    particles = pd.concat(particles, ignore_index=True)
+
+    files = dict(star=folder/"particles.star", cs=folder/"particles.cs", lst=folder/"particles.lst")
+    write_star(particles, files["star"])
+    write_cs(particles, files["cs"])
+    hps.dataframe2lst(particles.copy(), files["lst"].as_posix())
+    return files
+
+def write_star(particles, starFile):
+    # relion 3.1 star file with the columns read by star2dataframe
+    with open(starFile, "w") as fp:
+        fp.write(f"\ndata_optics\n\nloop_\n_rlnOpticsGroup #1\n_rlnPixelSize #2\n1 {particles['apix'].iloc[0]:.6f}\n")
+        fp.write("\ndata_particles\n\nloop_\n_rlnImageName #1\n_rlnOpticsGroup #2\n_rlnClassNumber #3\n_rlnHelicalTubeID #4\n_rlnAnglePsiPrior #5\n")
+        for pid, filename, class_number, tube, phi0 in zip(*[particles[c].values for c in "pid filename class helicaltube phi0".split()]):
+            fp.write(f"{pid+1:06d}@{filename} 1 {class_number} {tube+1} {phi0+90:.3f}\n")
+
+def write_cs(particles, csFile):
+    # cryosparc structured array with the fields read by cs2dataframe
+    dtype = [("uid", "<u8"), ("blob/path", f"S{particles['filename'].str.len().max()}"), ("blob/idx", "<u4"), ("blob/psize_A", "<f4"), ("filament/filament_uid", "<u4"), ("filament/filament_pose", "<f4"), ("alignments2D/class", "<u4")]
+    cs = np.zeros(len(particles), dtype=dtype)
+    cs["uid"] = np.arange(len(particles))
+    cs["blob/path"] = particles["filename"].str.encode("utf-8").values
+    cs["blob/idx"] = particles["pid"].values
+    cs["blob/psize_A"] = particles["apix"].values
+    cs["filament/filament_uid"] = particles["helicaltube"].values
+    cs["filament/filament_pose"] = -np.deg2rad(particles["phi0"].values + 90)
+    cs["alignments2D/class"] = particles["class"].values
+    with open(csFile, "wb") as fp:
+        np.save(fp, cs)
+
+def benchmark_star_reader(folder, nrows, seed=0, verbose=1):
+    # the columnar hps.star2dataframe against the gemmi -> JSON -> pandas round trip it replaced, on a star file of
+    # nrows particles with the columns of a typical RELION helical refinement
+    import time
+    import pandas as pd
+    folder = pathlib.Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    starFile = folder / f"particles_{nrows}.star"
+    if not starFile.exists():
+        rng = np.random.default_rng(seed)
+        pids = np.arange(nrows)
+        data = {
+            "rlnCoordinateX": rng.uniform(0, 4096, nrows).round(6), "rlnCoordinateY": rng.uniform(0, 4096, nrows).round(6),
+            "rlnHelicalTubeID": pids//20 % 100 + 1, "rlnAngleTiltPrior": np.full(nrows, 90.0), "rlnAnglePsiPrior": rng.uniform(-180, 180, nrows).round(6),
+            "rlnHelicalTrackLengthAngst": (pids % 20 * 21.92).round(6), "rlnAnglePsiFlipRatio": np.full(nrows, 0.5),
+            "rlnImageName": [f"{i%1000+1:06d}@Extract/job010/Movies/mic_{i//1000:05d}.mrcs" for i in pids],
+            "rlnMicrographName": [f"MotionCorr/job002/Movies/mic_{i//1000:05d}.mrc" for i in pids],
+            "rlnOpticsGroup": pids % 2 + 1, "rlnDefocusU": rng.uniform(5000, 30000, nrows).round(6), "rlnDefocusV": rng.uniform(5000, 30000, nrows).round(6),
+            "rlnDefocusAngle": rng.uniform(-180, 180, nrows).round(6), "rlnCtfBfactor": np.zeros(nrows), "rlnCtfScalefactor": np.ones(nrows),
+            "rlnPhaseShift": np.zeros(nrows), "rlnClassNumber": rng.integers(1, 51, nrows), "rlnNormCorrection": np.ones(nrows),
+            "rlnLogLikeliContribution": rng.normal(1e5, 1e3, nrows).round(6), "rlnMaxValueProbDistribution": rng.uniform(0, 1, nrows).round(6),
+        }
+        header = ["", "data_optics", "", "loop_", "_rlnOpticsGroup #1", "_rlnOpticsGroupName #2", "_rlnImagePixelSize #3", "_rlnPixelSize #4", "_rlnImageSize #5",
+                  "1 opticsGroup1 1.34 1.34 256", "2 opticsGroup2 1.07 1.07 320", "", "data_particles", "", "loop_"]
+        header += [f"_{c} #{i+1}" for i, c in enumerate(data)]
+        with open(starFile, "w") as fp:
+            fp.write("\n".join(header) + "\n")
+            pd.DataFrame(data).to_csv(fp, sep=" ", header=False, index=False)
+        if verbose:
+            print(f"Simulated {starFile}: {nrows} particles, {starFile.stat().st_size/2**20:.1f} MB")
+
+    result = dict(rows=nrows, MB=starFile.stat().st_size/2**20)
+    columns = "pid filename apix class helicaltube phi0".split()
+    particles = {}
+    for name, reader in [("columnar", hps.star2dataframe), ("gemmi_json", star2dataframe_gemmi_json)]:
+        t0 = time.time()
+        particles[name] = reader(starFile.as_posix())
+        result[f"{name}_seconds"] = time.time() - t0
+    new, old = (particles[name].reset_index(drop=True) for name in ("columnar", "gemmi_json"))
+    # pd.read_json parses floats to within 1 ulp (precise_float=False), which can flip the round(3) of phi0 at the ties
+    # (e.g. -4.8405 -> -4.841 instead of -4.84). such rows are counted, not reported as a difference
+    phi0_diff = np.abs(new["phi0"].values.astype(float) - old["phi0"].values.astype(float))
+    result["phi0_rounding_rows"] = int(np.count_nonzero(phi0_diff > 1e-9))
+    result["same"] = len(new) == len(old) and all(np.array_equal(new[c].values.astype(str), old[c].values.astype(str)) if c=="filename" else np.array_equal(new[c].values.astype(float), old[c].values.astype(float)) for c in columns if c!="phi0") and bool(np.all(phi0_diff < 1e-3+1e-9))
+    if verbose:
+        print(f"Star reader: {nrows} particles in {result['columnar_seconds']:.2f} s (columnar) vs {result['gemmi_json_seconds']:.2f} s (gemmi/JSON), {result['gemmi_json_seconds']/result['columnar_seconds']:.1f}x faster, {'same' if result['same'] else 'DIFFERENT'} {' '.join(columns)} ({result['phi0_rounding_rows']} phi0 differ by the 0.001 rounding step)")
+    return result
+
+def star2dataframe_gemmi_json(starFile):
+    # the star reader of the original version, as the reference of benchmark_star_reader
+    import pandas as pd
+    hps.import_with_auto_install("gemmi")
+    from gemmi import cif
+    star = cif.read_file(starFile)
+    if len(star) == 2:
+        optics = cif.Document()
+        optics.add_copied_block(star[0])
+        del star[0]
+        js = optics.as_json(True)  # True -> preserve case
+        optics = pd.read_json(js).T
+        d = {c.strip('_'): optics[c].values[0] for c in optics}
+        optics = pd.DataFrame(d)
+    else:
+        optics = None
+    js = star.as_json(True)  # True -> preserve case
+    data = pd.read_json(js).T
+    d = {c.strip('_'): data[c].values[0] for c in data}
+    data = pd.DataFrame(d)
+
+    tmp = data["rlnImageName"].str.split("@", expand=True)
+    indices, filenames = tmp.iloc[:,0], tmp.iloc[:, -1]
+    data["pid"] = indices.astype(int)-1
+    data["filename"] = filenames
+    if optics is not None:
+        for gn, g in data.groupby("rlnOpticsGroup", sort=False):
+            og_index = optics["rlnOpticsGroup"] == gn
+            if "rlnPixelSize" in optics:
+                data.loc[g.index, "apix"] = optics.loc[og_index, "rlnPixelSize"].astype(float).iloc[0]
+    if "rlnPixelSize" in data:
+        data.loc[:, "apix"] = data["rlnPixelSize"]
+    if "rlnClassNumber" in data:
+        data.loc[:, "class"] = data["rlnClassNumber"]
+    if "rlnHelicalTubeID" in data:
+        data.loc[:, "helicaltube"] = data["rlnHelicalTubeID"].astype(int)-1
+    if "rlnAnglePsiPrior" in data:
+        data.loc[:, "phi0"] = data["rlnAnglePsiPrior"].astype(float).round(3) - 90.0
+    return data
+
+def run_hill_power_spectra(inputFile, outputFolder, settings):
+    # runs hill_power_spectra.py in a new process and samples the memory of its process tree
+    import json, subprocess, time
+    hps.import_with_auto_install("psutil")
+    import psutil
+    outputFolder = pathlib.Path(outputFolder)
+    outputFolder.mkdir(parents=True, exist_ok=True)
+    cmd = [sys.executable, (code_dir / "hill_power_spectra.py").as_posix(), pathlib.Path(inputFile).as_posix(), "--showPlot", "0", "--verbose", "0", "--profile", "1",
+           "--outputPrefix", (outputFolder / "ps").as_posix(), "--groupby", settings["groupby"], "--align", str(settings["align"]),
+           "--batchSize", str(settings["batchSize"]), "--cpu", str(settings["cpu"]), "--backend", settings["backend"],
+           "--fftX", str(settings["fftX"]), "--fftY", str(settings["fftY"]), "--precision", settings["precision"]]
+    t0 = time.time()
+    with open(outputFolder / "log.txt", "w") as log:
+        proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+        process = psutil.Process(proc.pid)
+        peak_rss = 0
+        while proc.poll() is None:
+            try:
+                peak_rss = max(peak_rss, sum(p.memory_info().rss for p in [process] + process.children(recursive=True)))
+            except psutil.Error:
+                pass
+            time.sleep(0.05)
+    wall_seconds = time.time() - t0
+
+    result = dict(returncode=proc.returncode, wall_seconds=wall_seconds, tool_seconds=None, peak_rss_MB=peak_rss/2**20, particles=None, particles_per_s=None, stages={})
+    profileFiles = sorted(outputFolder.glob("ps*.profile.json"))
+    if proc.returncode==0 and profileFiles:
+        with open(profileFiles[0]) as fp:
+            profile = json.load(fp)
+        result["particles"] = profile["particles"]
+        # the time measured inside the tool, without the interpreter startup and the imports of each run
+        result["tool_seconds"] = profile["total_seconds"]
+        result["particles_per_s"] = profile["particles_per_s"]
+        result["stages"] = {f"{row['scope']}.{row['stage']}": row["seconds"] for row in profile["stages"]}
+    return result
+
+def git_commit():
+    import subprocess
+    try:
+        commit = subprocess.run(["git", "-C", code_dir.as_posix(), "describe", "--always", "--dirty"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = ""
+    return commit
+
+def load_hill_function(name):
+    # a function of the web app hill.py, compiled from its source without importing the app (and streamlit)
+    import ast
+    from scipy.spatial.transform import Rotation as R
+    tree = ast.parse((code_dir / "hill.py").read_text())
+    node = next(node for node in tree.body if isinstance(node, ast.FunctionDef) and node.name==name)
+    node.decorator_list = []    # the streamlit cache
+    scope = dict(np=np, R=R)
+    exec(compile(ast.Module(body=[node], type_ignores=[]), "hill.py", "exec"), scope)
+    return scope[name]
+
+def parse_command_line():
+    import argparse
+    parser = argparse.ArgumentParser(description="benchmark the throughput of hill_power_spectra.py with simulated helical segments",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--outputDir", metavar="<dir>", type=str, help="folder of the simulated data and of the outputs of each run", default="hill_power_spectra_benchmark")
+    parser.add_argument("--results", metavar="<file>", type=str, help="append the results of each run as one json line to this file", default="hill_power_spectra_benchmark.jsonl")
+    parser.add_argument("--boxSizes", metavar="<n>", type=int, nargs="+", help="box sizes of the simulated segments", default=[128, 256])
+    parser.add_argument("--formats", metavar="<star|cs|lst>", type=str, nargs="+", choices="star cs lst".split(), help="meta data formats to read", default=["star"])
+    parser.add_argument("--groupbys", metavar="<attr>", type=str, nargs="+", help="values of --groupby", default=["class", "helicaltube"])
+    parser.add_argument("--aligns", metavar="<0|1|2>", type=int, nargs="+", help="values of --align", default=[0])
+    parser.add_argument("--batchSizes", metavar="<n>", type=int, nargs="+", help="values of --batchSize", default=[50, 100])
+    parser.add_argument("--cpus", metavar="<n>", type=int, nargs="+", help="values of --cpu", default=[1, 2])
+    parser.add_argument("--backends", metavar="<threads|processes>", type=str, nargs="+", choices="threads processes".split(), help="values of --backend", default=["processes"])
+    parser.add_argument("--warmup", metavar="<n>", type=int, help="number of untimed runs of each box size before the timed runs", default=1)
+    parser.add_argument("--repeats", metavar="<n>", type=int, help="number of runs of each combination", default=1)
+    parser.add_argument("--fftX", metavar="<nx>", type=int, help="--fftX of all runs", default=256)
+    parser.add_argument("--fftY", metavar="<ny>", type=int, help="--fftY of all runs", default=512)
+    parser.add_argument("--precision", metavar="<single|double>", type=str, choices="single double".split(), help="--precision of all runs", default="double")
+    parser.add_argument("--micrographs", metavar="<n>", type=int, help="number of simulated micrograph stacks", default=4)
+    parser.add_argument("--particlesPerMicrograph", metavar="<n>", type=int, help="number of segments in each micrograph stack", default=100)
+    parser.add_argument("--segmentsPerTube", metavar="<n>", type=int, help="number of segments of each helical tube", default=20)
+    parser.add_argument("--classes", metavar="<n>", type=int, help="number of 2D classes", default=3)
+    parser.add_argument("--twist", metavar="<°>", type=float, help="helical twist", default=29.4)
+    parser.add_argument("--rise", metavar="<Å>", type=float, help="helical rise", default=21.92)
+    parser.add_argument("--csym", metavar="<n>", type=int, help="cyclic symmetry", default=6)
+    parser.add_argument("--helicalRadius", metavar="<Å>", type=float, help="radius of the helix", default=100)
+    parser.add_argument("--apix", metavar="<Å/pixel>", type=float, help="pixel size", default=2.0)
+    parser.add_argument("--noise", metavar="<float>", type=float, help="standard deviation of the gaussian noise relative to that of the signal", default=1.0)
+    parser.add_argument("--seed", metavar="<n>", type=int, help="random seed of the simulation", default=0)
+    parser.add_argument("--starRows", metavar="<n>", type=int, help="number of particles of the synthetic star file to time the star readers with, 0 to skip", default=0)
+    parser.add_argument("--verbose", metavar="<n>", type=int, help="verbose level", default=1)
+    args = parser.parse_args()
+    return args
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import pathlib, sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+import hill_power_spectra as hps
+
+@pytest.mark.parametrize("box_size, apix, cutoff_res, output_size", [(64, 2.0, 4.0, (128, 64)), (128, 1.5, 6.0, (512, 256)), (200, 1.1, 3.3, (256, 256)), (128, 1.34, 3.2, (300, 200))])
+def test_fft_rescale_backends_match_nufft(box_size, apix, cutoff_res, output_size):
+    images = np.random.default_rng(0).standard_normal((5, box_size, box_size)).astype(np.float32)
+    ref = hps.fft_rescale(images, apix, (cutoff_res,)*2, output_size, backend="nufft")
+    backends = ["czt"]
+    if hps.fft_backend_supported(output_size, apix, (cutoff_res,)*2): backends.append("fft")
+    for backend in backends:
+        data = hps.fft_rescale(images, apix, (cutoff_res,)*2, output_size, backend=backend)
+        assert data.shape == ref.shape
+        assert np.abs(data-ref).max() < 5e-6 * np.abs(ref).max(), backend
+
+@pytest.mark.parametrize("padding, extra", [(0, ""), (40, ""), (0, "\tnote=a=b")])  # an = in a value takes the slow path
+def test_lst_optional_integer_key(tmp_path, padding, extra):
+    # class is missing from the second line
+    lines = ["#LST", "0\tstack.mrcs\tclass=1\tphi0=10.5" + extra, "1\tstack.mrcs\tphi0=20.0", "2\tstack.mrcs\tclass=2\tphi0=30.25"]
+    (tmp_path / "p.lst").write_text("\n".join(line.ljust(padding) for line in lines) + "\n")
+    data = hps.lst2dataframe((tmp_path / "p.lst").as_posix())
+    assert str(data["class"].dtype) == "Int64"
+    assert data["class"].isna().tolist() == [False, True, False]
+    assert data["phi0"].tolist() == [10.5, 20.0, 30.25]
+    names = [hps.format_group_name(key, ["class"]) for key, _ in data.groupby("class", sort=True)]
+    assert names == [("class=1",), ("class=2",)]
+
+def write_extract_dataset(folder, nmicrographs=2, nparticles=6, box_size=64):
+    # micrographs and a star file of the particle coordinates for --extractBox
+    import mrcfile
+    rng = np.random.default_rng(1)
+    rows = []
+    for mi in range(nmicrographs):
+        with mrcfile.new(folder / f"mic{mi}.mrc", overwrite=True) as mrc:
+            mrc.set_data(rng.standard_normal((256, 256)).astype(np.float32))
+            mrc.voxel_size = 2.0
+        for pi in range(nparticles):
+            x, y = rng.uniform(box_size/2, 256-box_size/2, size=2)
+            rows.append(f"mic{mi}.mrc {x:.2f} {y:.2f} 1 {pi%2+1} 30.0")  # the same angle: the pid alone tells the particles apart
+    return rows
+
+def write_star(filename, rows):
+    header = ["", "data_optics", "", "loop_", "_rlnOpticsGroup #1", "_rlnMicrographPixelSize #2", "1 2.0", "", "data_particles", "", "loop_",
+              "_rlnMicrographName #1", "_rlnCoordinateX #2", "_rlnCoordinateY #3", "_rlnOpticsGroup #4", "_rlnHelicalTubeID #5", "_rlnAnglePsiPrior #6"]
+    filename.write_text("\n".join(header + rows) + "\n")
+
+def run_hill_power_spectra(folder, star, prefix, *options):
+    import subprocess
+    cmd = [sys.executable, str(pathlib.Path(hps.__file__)), str(folder / star), "--showPlot", "0", "--verbose", "0", "--fftX", "32", "--fftY", "64",
+           "--extractBox", "64", "--groupby", "helicaltube", "--minParticles", "1", "--outputPrefix", str(folder / prefix), *options]
+    subprocess.run(cmd, check=True, cwd=folder)
+    import mrcfile
+    return [mrcfile.read(next(folder.glob(f"{prefix}.*.{k}.mrcs"))) for k in ("ps", "pd")]
+
+def test_incremental_extract_identifies_particles_by_coordinates(tmp_path):
+    # the pid of the extracted particles is their order in the star file: a particle missing from the first star file
+    # shifts the pid of the later ones
+    rows = write_extract_dataset(tmp_path)
+    write_star(tmp_path / "subset.star", rows[:2] + rows[4:])
+    write_star(tmp_path / "all.star", rows)
+    run_hill_power_spectra(tmp_path, "subset.star", "inc", "--incremental", "1")
+    incremental = run_hill_power_spectra(tmp_path, "all.star", "inc", "--incremental", "1")
+    full = run_hill_power_spectra(tmp_path, "all.star", "full")
+    for a, b in zip(incremental, full):
+        assert a.shape == b.shape
+        assert np.abs(a-b).max() < 1e-5 * np.abs(b).max()
+
+def test_fourier_cache_extract_subset(tmp_path):
+    # a cache built from all the particles serves a star file without some of them
+    rows = write_extract_dataset(tmp_path)
+    write_star(tmp_path / "all.star", rows)
+    write_star(tmp_path / "subset.star", rows[:2] + rows[4:])
+    run_hill_power_spectra(tmp_path, "all.star", "all", "--fourierCache", str(tmp_path / "cache"))
+    cached = run_hill_power_spectra(tmp_path, "subset.star", "cached", "--fourierCache", str(tmp_path / "cache"))
+    uncached = run_hill_power_spectra(tmp_path, "subset.star", "uncached")
+    for a, b in zip(cached, uncached):
+        assert a.shape == b.shape
+        assert np.abs(a-b).max() < 1e-3 * np.abs(b).max()     # the phase difference cosines are cached in float16